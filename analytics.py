@@ -0,0 +1,260 @@
+import json
+import os
+import re
+
+import numpy as np
+import srt
+
+from fileio import open_atomic
+from corpus import episode_sort_key
+
+
+# CJK unified ideographs (+ extension A and compatibility ideographs), as codepoint ranges
+HANZI_RANGES = ((0x3400, 0x4DBF), (0x4E00, 0x9FFF), (0xF900, 0xFAFF))
+HANZI = re.compile('[' + ''.join(f'{chr(low)}-{chr(high)}' for low, high in HANZI_RANGES) + ']')
+
+
+def hanzi_codes(text):
+    '''Integer-encode text as a uint32 array of the codepoints of its hanzi.'''
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    mask = np.zeros(len(codes), dtype=bool)
+    for low, high in HANZI_RANGES:
+        mask |= (codes >= low) & (codes <= high)
+    return codes[mask]
+
+
+def concatenate(arrays):
+    return np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.uint32)
+
+
+def level_stats(ids, lengths, episode_series, n_series):
+    '''
+    Frequency and vocabulary growth of a token stream in level order.
+
+    ids are the tokens' integer ids (0..n-1), lengths the number of tokens of every episode
+    and episode_series the series index of every episode.
+    '''
+    n_types = int(ids.max()) + 1 if len(ids) else 0
+    token_episode = np.repeat(np.arange(len(lengths)), lengths)
+    token_series = episode_series[token_episode]
+
+    counts = np.bincount(ids, minlength=n_types)
+    series_counts = np.bincount(token_series * n_types + ids, minlength=n_series * n_types).reshape(n_series, n_types)
+
+    # tokens are in level order, so the first occurrence of a type is where it is introduced
+    _, first_token = np.unique(ids, return_index=True)
+    first_episode = token_episode[first_token]
+    first_series = token_series[first_token]
+
+    # a token is "known" if its type was introduced at an earlier level
+    known = first_series[ids] < token_series
+    tokens_per_series = series_counts.sum(axis=1)
+    new_per_series = np.bincount(first_series, minlength=n_series)
+    return {
+        'counts': counts,
+        'series_counts': series_counts,
+        'tokens_per_series': tokens_per_series,
+        'distinct_per_series': (series_counts > 0).sum(axis=1),
+        'new_per_series': new_per_series,
+        'cumulative': np.cumsum(new_per_series),
+        'known_per_series': np.bincount(token_series, weights=known, minlength=n_series),
+        'new_per_episode': np.bincount(first_episode, minlength=len(lengths)),
+    }
+
+
+class VocabularyAnalytics:
+    '''
+    Character and word frequency and vocabulary growth across the catalog.
+
+    Series are ordered by level as in series.json (beginner first) and episodes by number.
+    Every episode's text is kept as an array of hanzi codepoints and an array of word ids
+    in a cache file, so only episodes whose .srt changed are re-read; all the counting is
+    done with numpy over the concatenated arrays.
+    Cues are segmented into words with jieba through the annotate module, whose sentence cache
+    (.annotations.sqlite3 in the subtitle directory) is shared with Annotator.
+    '''
+    def __init__(self, subtitle_directory, series_json, cache_path):
+        self.subtitle_directory = subtitle_directory
+        self.cache_path = cache_path
+        with open(series_json, 'r') as f:
+            self.series_order = [entry['title'] for entry in json.load(f)]
+
+    def ordered_episodes(self):
+        '''(series, episode, srt path) of every converted episode in level order.'''
+        series_names = [entry.name for entry in os.scandir(self.subtitle_directory) if entry.is_dir()]
+        level = {title: i for i, title in enumerate(self.series_order)}
+        series_names.sort(key=lambda name: (level.get(name, len(level)), name))
+
+        episodes = []
+        for series in series_names:
+            series_dir = os.path.join(self.subtitle_directory, series)
+            for ep in sorted((entry.name for entry in os.scandir(series_dir) if entry.is_dir()), key=episode_sort_key):
+                srt_path = os.path.join(series_dir, ep, f'{ep}.srt')
+                if os.path.exists(srt_path):
+                    episodes.append((series, ep, srt_path))
+        return episodes
+
+    def load_cache(self):
+        '''The cached episodes, {(series, episode): (mtime_ns, size, codes, word ids)}, and the words the ids index.'''
+        if not os.path.exists(self.cache_path):
+            return {}, []
+        with np.load(self.cache_path) as cache:
+            if 'word_ids' not in cache.files:
+                # written before there were word tables
+                return {}, []
+            keys = json.loads(str(cache['keys']))
+            words = json.loads(str(cache['words']))
+            codes = np.split(cache['codes'], cache['offsets'][1:-1])
+            word_ids = np.split(cache['word_ids'], cache['word_offsets'][1:-1])
+        return {
+            tuple(key): (mtime_ns, size, episode_codes, episode_word_ids)
+            for (key, mtime_ns, size), episode_codes, episode_word_ids in zip(keys, codes, word_ids)
+        }, words
+
+    def save_cache(self, entries, words):
+        keys = [(list(key), mtime_ns, size) for key, (mtime_ns, size, _, _) in entries.items()]
+        codes = [episode_codes for _, _, episode_codes, _ in entries.values()]
+        word_ids = [episode_word_ids for _, _, _, episode_word_ids in entries.values()]
+        with open_atomic(self.cache_path, 'wb') as f:
+            np.savez(f, keys=json.dumps(keys), words=json.dumps(words, ensure_ascii=False),
+                     offsets=np.cumsum([0] + [len(array) for array in codes]), codes=concatenate(codes),
+                     word_offsets=np.cumsum([0] + [len(array) for array in word_ids]), word_ids=concatenate(word_ids))
+
+    def segment(self, texts):
+        '''
+        Split cue texts into words, looking them up in (and adding them to) the annotation cache.
+
+        :return: A dict of text -> list of words.
+        '''
+        from annotate import AnnotationCache, Annotator, sentence_hash
+
+        annotator = Annotator(self.subtitle_directory)
+        cache = AnnotationCache(os.path.join(self.subtitle_directory, Annotator.cache_filename))
+        try:
+            sentences = {sentence_hash(text): text for text in texts}
+            known = cache.lookup(sentences)
+            annotations = annotator.annotate_sentences([text for digest, text in sentences.items() if digest not in known])
+            cache.store(annotations)
+            known.update((digest, (words, pinyin)) for digest, words, pinyin in annotations)
+        finally:
+            cache.close()
+        return {text: known[digest][0] for digest, text in sentences.items()}
+
+    def episode_tokens(self):
+        '''
+        Hanzi codepoint and word id arrays of every episode in level order, re-reading only changed .srt files.
+        Only words with hanzi count, so punctuation and latin are left out.
+
+        :return: (a list of ((series, episode), codes, word ids), the list of words the ids index)
+        '''
+        cache, words = self.load_cache()
+        word_index = {word: i for i, word in enumerate(words)}
+        entries = {}
+        changed = {}
+        for series, ep, srt_path in self.ordered_episodes():
+            stat = os.stat(srt_path)
+            cached = cache.get((series, ep))
+            if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+                entries[(series, ep)] = cached
+                continue
+            with open(srt_path, 'r', encoding='utf-8') as f:
+                cues = [subtitle.content for subtitle in srt.parse(f.read())]
+            # keeps the episode's place in level order until its words are known
+            entries[(series, ep)] = None
+            changed[(series, ep)] = (stat, cues)
+
+        if changed:
+            segmented = self.segment({cue for _, cues in changed.values() for cue in cues})
+            for key, (stat, cues) in changed.items():
+                word_ids = [
+                    word_index.setdefault(word, len(word_index))
+                    for cue in cues for word in segmented[cue] if HANZI.search(word)
+                ]
+                entries[key] = (stat.st_mtime_ns, stat.st_size, hanzi_codes(''.join(cues)),
+                                np.array(word_ids, dtype=np.uint32))
+            words = list(word_index)
+
+        if changed or len(entries) != len(cache):
+            self.save_cache(entries, words)
+        return [(key, codes, word_ids) for key, (_, _, codes, word_ids) in entries.items()], words
+
+    def report(self, top=50):
+        '''
+        Compute the frequency tables and the vocabulary growth, of characters and of words.
+
+        :return: A dict with the catalog-wide 'characters' and 'words' tables (most frequent first),
+                 per 'series' stats (tokens, distinct characters, characters new at that level,
+                 cumulative vocabulary, and how much of the series' text is covered by
+                 characters already introduced at earlier levels, and the same for words)
+                 and per 'episodes' new character and word counts.
+        '''
+        episodes, words = self.episode_tokens()
+        keys = [key for key, _, _ in episodes]
+        series_names = list(dict.fromkeys(series for series, _ in keys))
+        series_index = {series: i for i, series in enumerate(series_names)}
+        episode_series = np.array([series_index[series] for series, _ in keys], dtype=np.int64)
+        n_series = len(series_names)
+
+        # integer ids for the characters and words that occur, in order of codepoint / word id
+        characters, char_ids = np.unique(concatenate([codes for _, codes, _ in episodes]), return_inverse=True)
+        word_vocabulary, word_ids = np.unique(concatenate([ids for _, _, ids in episodes]), return_inverse=True)
+        char_stats = level_stats(char_ids, np.array([len(codes) for _, codes, _ in episodes], dtype=np.int64),
+                            episode_series, n_series)
+        word_stats = level_stats(word_ids, np.array([len(ids) for _, _, ids in episodes], dtype=np.int64),
+                                 episode_series, n_series)
+
+        char_names = [chr(code) for code in characters]
+        word_names = [words[i] for i in word_vocabulary]
+
+        def table(stats, names, field):
+            order = np.argsort(-stats['counts'], kind='stable')[:top]
+            return [{field: names[i], 'count': int(stats['counts'][i])} for i in order]
+
+        def series_stats(stats, names, i):
+            '''(tokens, distinct, new, cumulative vocabulary, coverage by earlier levels, top 10) of series i.'''
+            tokens = stats['tokens_per_series'][i]
+            series_counts = stats['series_counts'][i]
+            return (
+                int(tokens),
+                int(stats['distinct_per_series'][i]),
+                int(stats['new_per_series'][i]),
+                int(stats['cumulative'][i]),
+                float(stats['known_per_series'][i] / tokens) if tokens else 0.0,
+                [names[c] for c in np.argsort(-series_counts, kind='stable')[:10] if series_counts[c]],
+            )
+
+        series_report = {}
+        for series, i in series_index.items():
+            tokens, distinct, new, cumulative, coverage, top_characters = series_stats(char_stats, char_names, i)
+            word_tokens, distinct_words, new_words, word_cumulative, word_coverage, top_words = \
+                series_stats(word_stats, word_names, i)
+            series_report[series] = {
+                'tokens': tokens,
+                'distinct_characters': distinct,
+                'new_characters': new,
+                'cumulative_vocabulary': cumulative,
+                'coverage_by_earlier_levels': coverage,
+                'top_characters': top_characters,
+                'words': word_tokens,
+                'distinct_words': distinct_words,
+                'new_words': new_words,
+                'cumulative_word_vocabulary': word_cumulative,
+                'word_coverage_by_earlier_levels': word_coverage,
+                'top_words': top_words,
+            }
+
+        return {
+            'characters': table(char_stats, char_names, 'char'),
+            'words': table(word_stats, word_names, 'word'),
+            'series': series_report,
+            'episodes': [
+                {'series': series, 'episode': ep, 'new_characters': int(char_stats['new_per_episode'][i]),
+                 'new_words': int(word_stats['new_per_episode'][i])}
+                for i, (series, ep) in enumerate(keys)
+            ],
+        }
+
+    def write_report(self, report_path, top=50):
+        report = self.report(top)
+        with open_atomic(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4, ensure_ascii=False)
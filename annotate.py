@@ -0,0 +1,244 @@
+import concurrent.futures
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+
+import srt
+
+from fileio import write_atomic
+from metrics import registry, Progress
+
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sentences (
+    hash TEXT PRIMARY KEY,
+    words TEXT NOT NULL,
+    pinyin TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS episodes (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+) WITHOUT ROWID;
+'''
+
+
+def sentence_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def load_dictionaries():
+    '''Load jieba's dictionary; the process pool runs this once per worker.'''
+    import jieba
+
+    jieba.setLogLevel(logging.WARNING)
+    jieba.initialize()
+
+
+def annotate_sentence(text):
+    '''
+    Segment text into words with jieba and give every word its pinyin (tone marks).
+
+    Whitespace is dropped; tokens without hanzi (punctuation, latin) are their own pinyin.
+    :return: (words, pinyin), two lists of the same length
+    '''
+    import jieba
+    from pypinyin import lazy_pinyin, Style
+
+    words = [word for word in jieba.lcut(text) if word.strip()]
+    return words, [''.join(lazy_pinyin(word, style=Style.TONE)) for word in words]
+
+
+def annotate_batch(texts):
+    '''Annotate a batch of sentences: [(hash, words, pinyin)].'''
+    return [(sentence_hash(text), *annotate_sentence(text)) for text in texts]
+
+
+class AnnotationCache:
+    '''
+    Sentence annotations kept in SQLite, keyed by the sha1 of the sentence text,
+    plus the mtime and size of every SRT file annotated so far.
+    The same sentence in any episode or series is only ever annotated once.
+    '''
+    def __init__(self, cache_path):
+        self.connection = sqlite3.connect(cache_path, timeout=60, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def lookup(self, hashes):
+        '''Return a dict of hash -> (words, pinyin) for the hashes that are cached.'''
+        found = {}
+        hashes = list(hashes)
+        with self.lock:
+            # stay under SQLite's bound parameter limit
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                rows = self.connection.execute(
+                    f'SELECT hash, words, pinyin FROM sentences WHERE hash IN ({", ".join("?" * len(chunk))})', chunk
+                )
+                for digest, words, pinyin in rows:
+                    found[digest] = (json.loads(words), json.loads(pinyin))
+        return found
+
+    def store(self, annotations):
+        '''Cache (hash, words, pinyin) annotations.'''
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO sentences (hash, words, pinyin) VALUES (?, ?, ?)',
+                ((digest, json.dumps(words, ensure_ascii=False), json.dumps(pinyin, ensure_ascii=False))
+                 for digest, words, pinyin in annotations)
+            )
+
+    def episode_stats(self):
+        with self.lock:
+            return {path: (mtime_ns, size) for path, mtime_ns, size in self.connection.execute('SELECT * FROM episodes')}
+
+    def record_episodes(self, stats):
+        '''Record the (mtime_ns, size) of annotated SRT files, from a dict of path -> stat.'''
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO episodes (path, mtime_ns, size) VALUES (?, ?, ?)',
+                ((path, stat.st_mtime_ns, stat.st_size) for path, stat in stats.items())
+            )
+
+    def forget_episodes(self, paths):
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM episodes WHERE path = ?', ((path,) for path in paths))
+
+
+class Annotator:
+    '''
+    Adds word segmentation and pinyin to every cue of the converted SRT files.
+
+    For each <ep>.srt it writes <ep>.annotated.srt and <ep>.annotated.txt, where every cue is
+    its words separated by spaces followed by a line with the pinyin of each word:
+
+        我们 去 公园 。
+        wǒmen qù gōngyuán 。
+
+    Annotations are cached per sentence in the output directory's .annotations.sqlite3, and SRT files
+    that didn't change since they were annotated are skipped, so after a sync only new sentences cost anything.
+    The sentences that aren't cached are annotated in batches on a process pool whose workers
+    load the jieba / pypinyin dictionaries once each (pip install jieba pypinyin).
+    '''
+    cache_filename = '.annotations.sqlite3'
+
+    def __init__(self, output_directory, batch_size=500):
+        self.output_directory = output_directory
+        self.batch_size = batch_size
+
+    def scan_srt_files(self):
+        '''Walk the output directory once and return a dict of converted SRT path -> os.stat_result.'''
+        srt_stats = {}
+        directories = [self.output_directory]
+        while directories:
+            with os.scandir(directories.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        directories.append(entry.path)
+                    elif entry.name.endswith('.srt') and not entry.name.endswith('.annotated.srt'):
+                        srt_stats[entry.path] = entry.stat()
+        return srt_stats
+
+    def annotate_sentences(self, texts, max_workers=None):
+        '''Annotate sentences in batches, on a process pool if there is more than one batch.
+
+        :return: [(hash, words, pinyin)]
+        '''
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        progress = Progress(len(texts), 'annotate')
+        annotations = []
+        if len(batches) > 1:
+            # spawned, not forked: the caller may have download or scheduler threads running
+            mp_context = multiprocessing.get_context('spawn')
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context,
+                                                        initializer=load_dictionaries) as executor:
+                for batch in executor.map(annotate_batch, batches):
+                    annotations.extend(batch)
+                    progress.update(len(batch))
+        elif batches:
+            load_dictionaries()
+            annotations = annotate_batch(batches[0])
+            progress.update(len(annotations))
+        progress.close()
+        return annotations
+
+    def annotate(self, max_workers=None, force=False):
+        '''Annotate the new or changed SRT files (all of them if force is set).
+
+        :return: The number of sentences that had to be annotated (weren't cached).
+        '''
+        cache = AnnotationCache(os.path.join(self.output_directory, self.cache_filename))
+        try:
+            annotated = cache.episode_stats()
+            srt_stats = {}
+            scanned = self.scan_srt_files()
+            keys = {os.path.relpath(srt_path, self.output_directory) for srt_path in scanned}
+            removed = [key for key in annotated if key not in keys]
+            for key in removed:
+                base_path = os.path.join(self.output_directory, os.path.splitext(key)[0])
+                for path in (base_path + '.annotated.srt', base_path + '.annotated.txt'):
+                    if os.path.exists(path):
+                        os.remove(path)
+            cache.forget_episodes(removed)
+
+            for srt_path, stat in scanned.items():
+                key = os.path.relpath(srt_path, self.output_directory)
+                base_path = os.path.splitext(srt_path)[0]
+                if (not force and annotated.get(key) == (stat.st_mtime_ns, stat.st_size)
+                        and os.path.exists(base_path + '.annotated.srt')):
+                    continue
+                srt_stats[srt_path] = stat
+
+            episodes = {}
+            for srt_path in srt_stats:
+                with open(srt_path, 'r', encoding='utf-8') as f:
+                    episodes[srt_path] = list(srt.parse(f.read()))
+
+            sentences = {}
+            for subtitles in episodes.values():
+                for subtitle in subtitles:
+                    sentences.setdefault(sentence_hash(subtitle.content), subtitle.content)
+            known = cache.lookup(sentences)
+            unseen = [text for digest, text in sentences.items() if digest not in known]
+            logger.info("Annotating %d files: %d sentences, %d not cached", len(episodes), len(sentences), len(unseen))
+
+            annotations = self.annotate_sentences(unseen, max_workers)
+            cache.store(annotations)
+            known.update((digest, (words, pinyin)) for digest, words, pinyin in annotations)
+
+            for srt_path, subtitles in episodes.items():
+                self.write_annotated(srt_path, subtitles, known)
+            cache.record_episodes({os.path.relpath(path, self.output_directory): stat for path, stat in srt_stats.items()})
+        finally:
+            cache.close()
+
+        registry.inc('sentences_annotated_total', len(unseen))
+        registry.inc('sentences_annotation_cached_total', len(sentences) - len(unseen))
+        return len(unseen)
+
+    def write_annotated(self, srt_path, subtitles, annotations):
+        '''Write <ep>.annotated.srt and <ep>.annotated.txt from the cues of srt_path and their annotations.'''
+        annotated = []
+        for subtitle in subtitles:
+            words, pinyin = annotations[sentence_hash(subtitle.content)]
+            annotated.append(srt.Subtitle(index=subtitle.index, start=subtitle.start, end=subtitle.end,
+                                          content=f"{' '.join(words)}\n{' '.join(pinyin)}"))
+
+        base_path = os.path.splitext(srt_path)[0]
+        for path, content in (
+            (base_path + '.annotated.srt', srt.compose(annotated, reindex=False)),
+            (base_path + '.annotated.txt', ''.join(subtitle.content + '\n' for subtitle in annotated)),
+        ):
+            write_atomic(path, content, encoding='utf-8')
@@ -0,0 +1,755 @@
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+import srt
+
+from clips import ClipExtractor, read_srt_cues
+from corpus import CorpusStore, build_corpus
+from hls import RenditionPreference, media_is_complete
+from scheduler import Scheduler
+from transport import HTTPTransport
+from utils import Converter, Downloader
+from workqueue import WorkQueue
+
+
+def copy_xml_tree(source_directory, destination_directory):
+    '''Copy only the XML subtitle files of source_directory, keeping the series/episode layout.'''
+    for root, _, files in os.walk(source_directory):
+        for file in files:
+            if not file.endswith('.xml'):
+                continue
+            destination = os.path.join(destination_directory, os.path.relpath(root, source_directory))
+            os.makedirs(destination, exist_ok=True)
+            shutil.copy(os.path.join(root, file), destination)
+
+
+def bench_conversion(subtitle_directory, max_workers=None):
+    '''
+    Time the old two-pass conversion (xml_to_srt then srt_to_txt) against the single-pass
+    Converter.convert_file, serially and across a process pool, on a copy of subtitle_directory.
+
+    :return: A dict mapping each path to its per-file cost in milliseconds.
+    '''
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        copy_xml_tree(subtitle_directory, tmp)
+        converter = Converter(tmp)
+        xml_paths = converter.find_xml_files()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            converter.xml_to_srt()
+            converter.srt_to_txt()
+            results['two_pass'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for xml_path in xml_paths:
+                converter.convert_file(xml_path)
+            results['single_pass'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            converter.convert(max_workers, force=True)
+            results['single_pass_pool'] = time.perf_counter() - start
+
+    per_file = {name: seconds * 1000 / max(1, len(xml_paths)) for name, seconds in results.items()}
+    print(f"Converted {len(xml_paths)} files")
+    for name, ms in per_file.items():
+        print(f"{name:>18}: {ms:7.2f} ms/file  ({results[name]:.2f} s total)")
+    return per_file
+
+
+def bench_corpus_load(subtitle_directory):
+    '''
+    Time loading every cue of the corpus from the .srt files against opening a packed corpus file,
+    both when only opening it and when reading every cue's text.
+    '''
+    results = {}
+    start = time.perf_counter()
+    cue_count = 0
+    for root, _, files in os.walk(subtitle_directory):
+        for file in files:
+            if file.endswith('.srt'):
+                with open(os.path.join(root, file), 'r', encoding='utf-8') as f:
+                    cue_count += len(list(srt.parse(f.read())))
+    results['srt_files'] = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus_path = os.path.join(tmp, 'corpus.lfc')
+        build_corpus(subtitle_directory, corpus_path)
+
+        start = time.perf_counter()
+        with CorpusStore(corpus_path) as store:
+            results['corpus_open'] = time.perf_counter() - start
+            for cue in range(len(store)):
+                store.cue(cue)
+        results['corpus_read_all'] = time.perf_counter() - start
+
+    print(f"Loaded {cue_count} cues")
+    for name, seconds in results.items():
+        print(f"{name:>18}: {seconds * 1000:9.2f} ms")
+    return results
+
+
+def time_word_by_word(converter, xml_paths):
+    '''
+    Read and collapse every word-by-word file of xml_paths (the others are skipped).
+
+    :return: (per-file seconds, total cues, total sentences, total words)
+    '''
+    latencies = []
+    cue_count = sentence_count = word_count = 0
+    for xml_path in xml_paths:
+        start = time.perf_counter()
+        cues = converter.read_cues(xml_path)
+        if not any("[@" in text for _, _, text in cues):
+            continue
+        sentences, words = converter.collapse_word_by_word(cues)
+        latencies.append(time.perf_counter() - start)
+        cue_count += len(cues)
+        sentence_count += len(sentences)
+        word_count += len(words)
+    return latencies, cue_count, sentence_count, word_count
+
+
+def bench_word_by_word(subtitle_directory):
+    '''Time reading and collapsing every word-by-word XML file of subtitle_directory into sentences and word timings.'''
+    converter = Converter(subtitle_directory)
+    latencies, cue_count, sentence_count, word_count = time_word_by_word(converter, converter.find_xml_files())
+    seconds = sum(latencies)
+    print(f"Collapsed {len(latencies)} word-by-word files: {cue_count} cues into {sentence_count} sentences and {word_count} words")
+    print(f"{'word_by_word':>18}: {seconds * 1000 / max(1, len(latencies)):7.2f} ms/file  ({seconds:.2f} s total, "
+          f"p99 {percentile(latencies, 99) * 1000:.2f} ms)")
+    return latencies
+
+
+
+HANZI = '我你他她们是的了在有小大人一不这个看好说去来吃水天上下中火山木口日月书猫狗鸟鱼花草家学朋友'
+PINYIN_INITIALS = ['b', 'p', 'm', 'f', 'd', 't', 'n', 'l', 'g', 'k', 'h', 'zh', 'sh', 'x', 'j', 'q']
+PINYIN_FINALS = ['ā', 'á', 'ǎ', 'à', 'ō', 'é', 'ǐ', 'ù', 'ǖ', 'ēn', 'áng', 'ìng']
+
+
+def synthetic_sentence(rng):
+    '''A random sentence as (pinyin words, hanzi words), 2-6 words of 1-2 characters.'''
+    hanzi_words, pinyin_words = [], []
+    for _ in range(rng.randint(2, 6)):
+        length = rng.randint(1, 2)
+        hanzi_words.append(''.join(rng.choice(HANZI) for _ in range(length)))
+        pinyin_words.append(''.join(rng.choice(PINYIN_INITIALS) + rng.choice(PINYIN_FINALS) for _ in range(length)))
+    return pinyin_words, hanzi_words
+
+
+def synthetic_caption_xml(rng, sentences, word_by_word):
+    '''
+    Caption XML in the <Subtitle><Paragraph> schema served by the cdn.
+    Word-by-word files repeat every sentence once per word with that word wrapped in [@ @].
+    '''
+    paragraphs = []
+    time_ms = rng.randint(1000, 8000)
+
+    def add(text, duration):
+        nonlocal time_ms
+        paragraphs.append(
+            f'  <Paragraph>\n    <Number>{len(paragraphs) + 1}</Number>\n'
+            f'    <StartMilliseconds>{time_ms}</StartMilliseconds>\n'
+            f'    <EndMilliseconds>{time_ms + duration}</EndMilliseconds>\n'
+            f'    <Text>{escape(text)}</Text>\n  </Paragraph>\n'
+        )
+        time_ms += duration + 1
+
+    for _ in range(sentences):
+        pinyin_words, hanzi_words = synthetic_sentence(rng)
+        add(' '.join(pinyin_words) + '.\n' + ''.join(hanzi_words) + '。', rng.randint(1500, 5000))
+        if word_by_word:
+            for i in range(len(hanzi_words)):
+                pinyin = ' '.join(f'[@{w}@]' if j == i else w for j, w in enumerate(pinyin_words))
+                hanzi = ''.join(f'[@{w}@]' if j == i else w for j, w in enumerate(hanzi_words))
+                add(pinyin + '.\n' + hanzi + '。', rng.randint(200, 900))
+
+    return '<?xml version="1.0" encoding="utf-8"?>\n<Subtitle>\n' + ''.join(paragraphs) + '</Subtitle>'
+
+
+def encode_segments(directory, height, segments, segment_format='ts', duration=4):
+    '''
+    Encode ffmpeg's testsrc pattern and a tone at height lines into an HLS stream of segments segments
+    of duration seconds: directory/stream.m3u8 and <n>.ts, or <n>.m4s and init.mp4 with segment_format 'fmp4'.
+    Needs ffmpeg.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    length = segments * duration
+    extension = 'm4s' if segment_format == 'fmp4' else 'ts'
+    subprocess.run([
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f'testsrc=duration={length}:size={height * 16 // 9 // 2 * 2}x{height}:rate=25',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={length}',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-g', str(25 * duration), '-c:a', 'aac',
+        '-f', 'hls', '-hls_time', str(duration), '-hls_list_size', '0',
+        '-hls_segment_type', 'fmp4' if segment_format == 'fmp4' else 'mpegts', '-hls_fmp4_init_filename', 'init.mp4',
+        '-hls_segment_filename', os.path.join(directory, f'%d.{extension}'), os.path.join(directory, 'stream.m3u8'),
+    ], check=True)
+
+
+def generate_corpus(directory, series=5, episodes=20, sentences=30, word_by_word_share=0.5, segments=6, seed=0,
+                    renditions=(1080,), media=False, segment_format='ts'):
+    '''
+    Write a synthetic cdn tree into directory:
+    captionxml/<id>.xml, hls/<height>/<id>/stream.m3u8 and its segments for every height in renditions.
+
+    The segments are random bytes with sizes proportional to the number of pixels, which is enough to download them.
+    With media, they are a real stream that ffmpeg can remux, in segment_format ('ts' like the cdn's, or 'fmp4'):
+    encoded once per height (see encode_segments) and hard linked into every episode. Needs ffmpeg.
+
+    :return: The catalog as {series: [{'title', 'id'}]}, the shape of urls.json without the urls.
+    '''
+    rng = random.Random(seed)
+    catalog = {}
+    os.makedirs(os.path.join(directory, 'captionxml'), exist_ok=True)
+    if media:
+        for height in renditions:
+            encode_segments(os.path.join(directory, 'media', str(height)), height, segments, segment_format)
+    for s in range(series):
+        catalog[f'series-{s}'] = []
+        for e in range(episodes):
+            ep_id = f'C{s:03d}{e:04d}'
+            catalog[f'series-{s}'].append({'title': f'Series {s} - {e}', 'id': ep_id})
+
+            word_by_word = rng.random() < word_by_word_share
+            with open(os.path.join(directory, 'captionxml', f'{ep_id}.xml'), 'w', encoding='utf-8') as f:
+                f.write(synthetic_caption_xml(rng, sentences, word_by_word))
+
+            for height in renditions:
+                hls_dir = os.path.join(directory, 'hls', str(height), ep_id)
+                os.makedirs(hls_dir, exist_ok=True)
+                if media:
+                    media_dir = os.path.join(directory, 'media', str(height))
+                    for name in os.listdir(media_dir):
+                        os.link(os.path.join(media_dir, name), os.path.join(hls_dir, name))
+                    continue
+                playlist = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:4', '#EXT-X-MEDIA-SEQUENCE:0']
+                for n in range(segments):
+                    with open(os.path.join(hls_dir, f'{n}.ts'), 'wb') as f:
+                        f.write(rng.randbytes(188 * max(1, 64 * height * height // (1080 * 1080))))
+                    playlist += ['#EXTINF:4.000,', f'{n}.ts']
+                playlist.append('#EXT-X-ENDLIST')
+                with open(os.path.join(hls_dir, 'stream.m3u8'), 'w') as f:
+                    f.write('\n'.join(playlist) + '\n')
+    return catalog
+
+
+class MockCDN:
+    '''
+    Local HTTP server for a tree written by generate_corpus, standing in for cdn.littlefox.co.kr.
+
+    Every response is delayed by latency seconds (plus up to jitter) and a share of them
+    (error_rate) are answered with a 503, to exercise retries and backoff.
+    Files get an ETag so conditional requests can be answered with 304.
+    '''
+    def __init__(self, directory, latency=0.02, jitter=0.01, error_rate=0.0, seed=0):
+        cdn = self
+        self.directory = directory
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                cdn.handle(self)
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            # the default backlog of 5 drops connections from a 20 thread client and adds 1 s SYN retries
+            request_queue_size = 128
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def handle(self, request):
+        with self.lock:
+            self.requests += 1
+            delay = self.latency + self.rng.random() * self.jitter
+            fail = self.rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        time.sleep(delay)
+
+        path = os.path.normpath(os.path.join(self.directory, request.path.split('?')[0].lstrip('/')))
+        if fail or not path.startswith(self.directory) or not os.path.isfile(path):
+            request.send_response(503 if fail else 404)
+            request.send_header('Content-Length', '0')
+            request.end_headers()
+            return
+
+        stat = os.stat(path)
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        if request.headers.get('If-None-Match') == etag:
+            request.send_response(304)
+            request.send_header('ETag', etag)
+            request.send_header('Content-Length', '0')
+            request.end_headers()
+            return
+
+        with open(path, 'rb') as f:
+            body = f.read()
+        with self.lock:
+            self.bytes += len(body)
+        request.send_response(200)
+        request.send_header('ETag', etag)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def urls_json(self, catalog, height=1080):
+        '''The catalog in urls.json shape, with xml and stream urls (of the height rendition) pointing at this server.'''
+        return {
+            series: [
+                dict(ep, xml_url=f'{self.url}/captionxml/{ep["id"]}.xml', stream_url=f'{self.url}/hls/{height}/{ep["id"]}/stream.m3u8')
+                for ep in episodes
+            ]
+            for series, episodes in catalog.items()
+        }
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TimedTransport(HTTPTransport):
+    '''HTTPTransport that records the wall time of every request (retries included).'''
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.latencies = []
+        self.bytes = 0
+
+    def request(self, method, url, **kwargs):
+        start = time.perf_counter()
+        response = super().request(method, url, **kwargs)
+        self.latencies.append(time.perf_counter() - start)
+        self.bytes += len(response.content)
+        return response
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def peak_rss_kb():
+    '''Peak resident set size of this process and its finished children, in KiB (Linux units).'''
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def stage_download(cdn_directory, catalog, latency, error_rate, threads, host_rate):
+    '''Download every caption XML and playlist from a MockCDN with the Downloader.'''
+    with tempfile.TemporaryDirectory() as tmp, MockCDN(cdn_directory, latency=latency, error_rate=error_rate) as cdn:
+        urls_json = os.path.join(tmp, 'urls.json')
+        with open(urls_json, 'w') as f:
+            json.dump(cdn.urls_json(catalog), f)
+
+        scheduler = Scheduler(threads, host_rate=host_rate)
+        transport = TimedTransport(backoff_base=0.05, scheduler=scheduler)
+        with contextlib.redirect_stdout(io.StringIO()):
+            downloader = Downloader(urls_json, os.path.join(tmp, 'out'), transport=transport, scheduler=scheduler)
+            start = time.perf_counter()
+            downloader.download_xml_subtitles(threads)
+            downloader.download_stream_files(threads)
+            seconds = time.perf_counter() - start
+
+        return {
+            'seconds': seconds,
+            'items': len(transport.latencies),
+            'throughput_per_s': len(transport.latencies) / seconds,
+            'bytes': transport.bytes,
+            'p50_ms': percentile(transport.latencies, 50) * 1000,
+            'p99_ms': percentile(transport.latencies, 99) * 1000,
+            'server_requests': cdn.requests,
+            'injected_errors': cdn.errors,
+            'peak_rss_kb': peak_rss_kb(),
+        }
+
+
+def stage_conversion(cdn_directory, catalog, workers):
+    '''Convert every generated caption XML to SRT and TXT with Converter.convert.'''
+    with tempfile.TemporaryDirectory() as tmp:
+        latencies = []
+        converter = Converter(tmp)
+        for series, episodes in catalog.items():
+            for ep in episodes:
+                ep_dir = os.path.join(tmp, series, ep['id'])
+                os.makedirs(ep_dir)
+                shutil.copy(os.path.join(cdn_directory, 'captionxml', f'{ep["id"]}.xml'), ep_dir)
+
+        xml_paths = converter.find_xml_files()
+        with contextlib.redirect_stdout(io.StringIO()):
+            # per-file latency measured serially, throughput with the process pool
+            for xml_path in xml_paths[:200]:
+                start = time.perf_counter()
+                converter.convert_file(xml_path)
+                latencies.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            converter.convert(workers, force=True)
+            seconds = time.perf_counter() - start
+
+        return {
+            'seconds': seconds,
+            'items': len(xml_paths),
+            'throughput_per_s': len(xml_paths) / seconds,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'peak_rss_kb': peak_rss_kb(),
+        }
+
+
+def stage_word_by_word(cdn_directory, catalog):
+    '''Time reading and collapsing (Converter.read_cues + collapse_word_by_word) every word-by-word file.'''
+    converter = Converter(cdn_directory)
+    xml_paths = [
+        os.path.join(cdn_directory, 'captionxml', f'{ep["id"]}.xml') for episodes in catalog.values() for ep in episodes
+    ]
+    latencies, _, _, word_count = time_word_by_word(converter, xml_paths)
+
+    seconds = sum(latencies)
+    return {
+        'seconds': seconds,
+        'items': len(latencies),
+        'words': word_count,
+        'throughput_per_s': len(latencies) / seconds if seconds else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+
+def media_height(path):
+    '''Height of the video stream of a media file (0 for audio only), from ffmpeg's header dump.'''
+    output = subprocess.run(['ffmpeg', '-hide_banner', '-i', path], capture_output=True, text=True).stderr
+    match = re.search(r'Video: .*?, (\d+)x(\d+)', output)
+    return int(match.group(2)) if match else 0
+
+
+def directory_size(directory):
+    return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(directory) for file in files)
+
+
+def download_worker(queue_path, output_directory, threads):
+    logging.disable(logging.WARNING)
+    return Downloader(None, output_directory).work(WorkQueue(queue_path), threads=threads, poll_interval=0.1)
+
+
+def stage_workers(cdn_directory, catalog, latency, workers, threads, rendition=None):
+    '''
+    Download every episode's mp4 from a MockCDN with workers processes sharing one WorkQueue
+    and check that every job was completed exactly once, into a file ffmpeg reads without errors
+    (and reports the heights of the renditions that were stored). Needs ffmpeg.
+    '''
+    with tempfile.TemporaryDirectory() as tmp, MockCDN(cdn_directory, latency=latency) as cdn:
+        urls_json = os.path.join(tmp, 'urls.json')
+        with open(urls_json, 'w') as f:
+            json.dump(cdn.urls_json(catalog), f)
+        output_directory = os.path.join(tmp, 'out')
+        queue_path = os.path.join(tmp, 'queue.sqlite3')
+        work_queue = WorkQueue(queue_path)
+        Downloader(urls_json, output_directory, rendition=rendition).queue_mp4s(work_queue)
+
+        start = time.perf_counter()
+        with concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(download_worker, queue_path, output_directory, threads) for _ in range(workers)]
+            completed = [future.result() for future in futures]
+        seconds = time.perf_counter() - start
+
+        completions = [count for count, in work_queue.connection.execute('SELECT completions FROM jobs')]
+        media_paths = [
+            os.path.join(root, file) for root, _, files in os.walk(output_directory)
+            for file in files if file.endswith(('.mp4', '.m4a'))
+        ]
+        return {
+            'seconds': seconds,
+            'items': len(completions),
+            'throughput_per_s': len(completions) / seconds,
+            'exactly_once': float(all(count == 1 for count in completions)),
+            'complete_files': sum(map(media_is_complete, media_paths)),
+            'heights': sorted(set(map(media_height, media_paths))),
+            'min_worker_share': min(completed) / max(sum(completed), 1),
+            'server_requests': cdn.requests,
+            'server_bytes': cdn.bytes,
+            'output_bytes': directory_size(output_directory),
+        }
+
+
+def run_scaling(series=2, episodes=20, segments=6, latency=0.05, worker_counts=(1, 2, 4), threads=4,
+                renditions=(1080,), rendition=None, segment_format='ts'):
+    '''Run stage_workers with an increasing number of workers and print the throughput scaling.'''
+    if shutil.which('ffmpeg') is None:
+        raise RuntimeError("The worker benchmark remuxes with ffmpeg, which isn't on the PATH")
+
+    with tempfile.TemporaryDirectory() as cdn_directory:
+        catalog = generate_corpus(cdn_directory, series, episodes, segments=segments, renditions=renditions, media=True,
+                                  segment_format=segment_format)
+        results = {
+            workers: stage_workers(cdn_directory, catalog, latency, workers, threads, rendition) for workers in worker_counts
+        }
+
+    base = results[worker_counts[0]]['throughput_per_s'] / worker_counts[0]
+    for workers, metrics in results.items():
+        print(f"{workers:>3} workers: {metrics['throughput_per_s']:8.2f} episodes/s"
+              f"  efficiency {metrics['throughput_per_s'] / (base * workers) * 100:5.1f}%"
+              f"  exactly once: {bool(metrics['exactly_once'])}  complete files: {metrics['complete_files']}/{metrics['items']}"
+              f"  heights: {metrics['heights']}  server requests: {metrics['server_requests']}"
+              f"  transferred: {metrics['server_bytes'] / 1e6:.2f} MB  stored: {metrics['output_bytes'] / 1e6:.2f} MB")
+    return results
+
+
+def generate_media(directory, episodes=4, duration=120, video=True, seed=0):
+    '''
+    Write episodes of generated test media (ffmpeg's testsrc pattern and a tone) with synthetic SRT cues
+    in the Downloader's <series>/<ep>/<ep>.mp4 layout: cues of 1-4 s separated by gaps of 0-0.8 s,
+    some of them touching or overlapping the next one. Needs ffmpeg.
+
+    :return: The number of cues written.
+    '''
+    rng = random.Random(seed)
+    media_path = os.path.join(directory, 'source.mp4')
+    command = ['ffmpeg', '-y', '-loglevel', 'error']
+    if video:
+        command += ['-f', 'lavfi', '-i', f'testsrc=duration={duration}:size=640x360:rate=25']
+    command += ['-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}', '-c:a', 'aac']
+    if video:
+        command += ['-c:v', 'libx264', '-preset', 'ultrafast', '-g', '250']
+    subprocess.run(command + [media_path], check=True)
+
+    cue_count = 0
+    for n in range(1, episodes + 1):
+        ep = f'{n}_clip-test'
+        ep_dir = os.path.join(directory, 'Clip Test', ep)
+        os.makedirs(ep_dir)
+        shutil.copy(media_path, os.path.join(ep_dir, f'{ep}.mp4'))
+
+        subtitles = []
+        position = rng.uniform(0, 1)
+        while position < duration - 1:
+            end = min(duration, position + rng.uniform(1, 4))
+            subtitles.append(srt.Subtitle(len(subtitles) + 1, timedelta(seconds=position), timedelta(seconds=end), '你好'))
+            position = end + rng.choice((-0.1, 0, rng.uniform(0, 0.8)))
+        with open(os.path.join(ep_dir, f'{ep}.srt'), 'w', encoding='utf-8') as f:
+            f.write(srt.compose(subtitles))
+        cue_count += len(subtitles)
+    os.remove(media_path)
+    return cue_count
+
+
+def clip_per_cue(srt_path, media_path, video):
+    '''The one-ffmpeg-per-clip way ClipExtractor replaces, for comparison.'''
+    clips_directory = os.path.join(os.path.dirname(media_path), 'clips-per-cue')
+    os.makedirs(clips_directory, exist_ok=True)
+    extension = 'mp4' if video else 'm4a'
+    for index, start, end in read_srt_cues(srt_path):
+        command = ['ffmpeg', '-y', '-loglevel', 'error', '-ss', f'{start / 1000:.3f}', '-to', f'{end / 1000:.3f}',
+                   '-i', media_path]
+        command += ['-c:v', 'libx264', '-preset', 'veryfast', '-c:a', 'aac'] if video else ['-vn', '-c:a', 'copy']
+        subprocess.run(command + [os.path.join(clips_directory, f'{index:04d}.{extension}')], check=True)
+
+
+def media_duration(path):
+    '''Duration of a media file in seconds, from ffmpeg's header dump.'''
+    output = subprocess.run(['ffmpeg', '-hide_banner', '-i', path], capture_output=True, text=True).stderr
+    hours, minutes, seconds = output.split('Duration: ', 1)[1].split(',', 1)[0].split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def run_clips(episodes=4, duration=120, video=False, workers=None, baseline=True):
+    '''
+    Extract the clips of generated episodes with ClipExtractor, check them against their cues,
+    time a second (manifest-skipped) run and optionally the one-process-per-clip way.
+    '''
+    if shutil.which('ffmpeg') is None:
+        raise RuntimeError("The clips benchmark needs ffmpeg on the PATH")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        cue_count = generate_media(directory, episodes, duration, video)
+        extractor = ClipExtractor(directory, video=video)
+
+        start = time.perf_counter()
+        extractor.extract(workers)
+        results['seconds'] = time.perf_counter() - start
+        start = time.perf_counter()
+        extractor.extract(workers)
+        results['rerun_seconds'] = time.perf_counter() - start
+
+        errors = []
+        clip_count = 0
+        for srt_path, media_path in extractor.find_episodes():
+            clips_directory = os.path.join(os.path.dirname(media_path), extractor.clips_dirname)
+            cues = read_srt_cues(srt_path)
+            for (index, start_ms, end_ms), following in zip(cues, cues[1:] + [None]):
+                clip_path = os.path.join(clips_directory, f'{index:04d}.{"mp4" if video else "m4a"}')
+                if following:
+                    # overlapping cues are cut where the next one starts
+                    end_ms = min(end_ms, following[1])
+                if os.path.exists(clip_path):
+                    clip_count += 1
+                    errors.append(abs(media_duration(clip_path) - (end_ms - start_ms) / 1000))
+        results['cues'] = cue_count
+        results['clips'] = clip_count
+        results['p50_duration_error_ms'] = percentile(errors, 50) * 1000
+        results['p99_duration_error_ms'] = percentile(errors, 99) * 1000
+
+        if baseline:
+            start = time.perf_counter()
+            for srt_path, media_path in extractor.find_episodes():
+                clip_per_cue(srt_path, media_path, video)
+            results['per_cue_seconds'] = time.perf_counter() - start
+
+    for metric, value in results.items():
+        print(f"{metric:>22}: {value:10.2f}")
+    if baseline:
+        print(f"{'speedup':>22}: {results['per_cue_seconds'] / results['seconds']:10.2f}x")
+    return results
+
+
+def run_stage(stage, *args):
+    '''Run a stage in a fresh process so its peak RSS is its own.'''
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(stage, *args).result()
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(series=5, episodes=40, sentences=30, word_by_word_share=0.5, latency=0.02, error_rate=0.01,
+              threads=20, host_rate=None, workers=None, output=None, baseline=None):
+    '''
+    Generate a synthetic corpus, run the download, conversion and word-by-word stages against it
+    and return (and optionally write to output) the results as a dict.
+    If baseline names an earlier results file, the change of every metric is printed next to it.
+    '''
+    params = {
+        'series': series, 'episodes': episodes, 'sentences': sentences, 'word_by_word_share': word_by_word_share,
+        'latency': latency, 'error_rate': error_rate, 'threads': threads, 'host_rate': host_rate, 'workers': workers,
+    }
+    with tempfile.TemporaryDirectory() as cdn_directory:
+        catalog = generate_corpus(cdn_directory, series, episodes, sentences, word_by_word_share)
+        stages = {
+            'download': run_stage(stage_download, cdn_directory, catalog, latency, error_rate, threads, host_rate),
+            'conversion': run_stage(stage_conversion, cdn_directory, catalog, workers),
+            'word_by_word': run_stage(stage_word_by_word, cdn_directory, catalog),
+        }
+
+    results = {
+        'revision': git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'params': params,
+        'stages': stages,
+    }
+
+    previous = None
+    if baseline:
+        with open(baseline, 'r') as f:
+            previous = json.load(f)['stages']
+
+    for name, metrics in stages.items():
+        print(name)
+        for metric, value in metrics.items():
+            line = f"  {metric:>18}: {value:12.2f}"
+            if previous and name in previous and previous[name].get(metric):
+                line += f"  ({(value / previous[name][metric] - 1) * 100:+.1f}%)"
+            print(line)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=4)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the Downloader and Converter")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    corpus_parser = subparsers.add_parser('corpus', help="conversion and corpus loading on a real subtitles directory")
+    corpus_parser.add_argument('subtitle_directory', nargs='?', default='subtitles')
+
+    suite_parser = subparsers.add_parser('suite', help="synthetic corpus served by a local mock cdn")
+    suite_parser.add_argument('--series', type=int, default=5)
+    suite_parser.add_argument('--episodes', type=int, default=40, help="episodes per series")
+    suite_parser.add_argument('--sentences', type=int, default=30, help="sentences per episode")
+    suite_parser.add_argument('--word-by-word-share', type=float, default=0.5)
+    suite_parser.add_argument('--latency', type=float, default=0.02, help="seconds added to every response")
+    suite_parser.add_argument('--error-rate', type=float, default=0.01, help="share of responses answered with 503")
+    suite_parser.add_argument('--threads', type=int, default=20)
+    suite_parser.add_argument('--host-rate', type=float, help="scheduler requests per second per host (default: no limit)")
+    suite_parser.add_argument('--workers', type=int, default=None)
+    suite_parser.add_argument('--output', help="write the results to this json file")
+    suite_parser.add_argument('--baseline', help="earlier results json to compare against")
+
+    workers_parser = subparsers.add_parser('workers', help="mp4 download workers sharing a queue, 1..n processes")
+    workers_parser.add_argument('--series', type=int, default=2)
+    workers_parser.add_argument('--episodes', type=int, default=20, help="episodes per series")
+    workers_parser.add_argument('--segments', type=int, default=6, help="segments per episode")
+    workers_parser.add_argument('--latency', type=float, default=0.05, help="seconds added to every response")
+    workers_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    workers_parser.add_argument('--threads', type=int, default=4, help="episodes per worker at once")
+    workers_parser.add_argument('--renditions', type=int, nargs='+', default=[1080], help="heights the cdn serves")
+    workers_parser.add_argument('--max-height', type=int)
+    workers_parser.add_argument('--audio-only', action='store_true')
+    workers_parser.add_argument('--segment-format', choices=['ts', 'fmp4'], default='ts',
+                                help="segments the cdn serves: MPEG-TS like the real one, or fragmented mp4")
+
+    clips_parser = subparsers.add_parser('clips', help="clip extraction from generated test media, needs ffmpeg")
+    clips_parser.add_argument('--episodes', type=int, default=4)
+    clips_parser.add_argument('--duration', type=int, default=120, help="seconds per episode")
+    clips_parser.add_argument('--video', action='store_true', help="video clips instead of audio only")
+    clips_parser.add_argument('--workers', type=int, default=None, help="episodes at once")
+    clips_parser.add_argument('--no-baseline', action='store_true', help="skip the one-ffmpeg-per-clip comparison")
+
+    args = parser.parse_args()
+    if args.command == 'clips':
+        run_clips(args.episodes, args.duration, args.video, args.workers, not args.no_baseline)
+    elif args.command == 'workers':
+        run_scaling(args.series, args.episodes, args.segments, args.latency, tuple(args.workers), args.threads,
+                    tuple(args.renditions), RenditionPreference(args.max_height, audio_only=args.audio_only),
+                    args.segment_format)
+    elif args.command == 'corpus':
+        bench_conversion(args.subtitle_directory)
+        bench_corpus_load(args.subtitle_directory)
+        bench_word_by_word(args.subtitle_directory)
+    else:
+        run_suite(args.series, args.episodes, args.sentences, args.word_by_word_share, args.latency,
+                  args.error_rate, args.threads, args.host_rate, args.workers, args.output, args.baseline)
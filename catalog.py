@@ -0,0 +1,241 @@
+import json
+import os
+import sqlite3
+import threading
+from urllib.request import pathname2url
+
+from fileio import write_atomic
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS series (
+    title TEXT PRIMARY KEY,
+    id TEXT UNIQUE,
+    position INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS episodes (
+    series TEXT NOT NULL REFERENCES series(title),
+    id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    xml_url TEXT,
+    stream_url TEXT,
+    -- whether the url was ever set, as urls.json tells a missing url apart from a null (unresolved) one
+    has_xml_url INTEGER NOT NULL DEFAULT 0,
+    has_stream_url INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (series, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS episodes_order ON episodes(series, position);
+-- the series.json / urls.json files the catalog is in sync with, see sync_json
+CREATE TABLE IF NOT EXISTS json_files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+) WITHOUT ROWID;
+'''
+
+
+class CatalogStore:
+    '''
+    The scraped catalog (series, episodes and their xml / stream urls) in SQLite.
+
+    Replaces rewriting all of series.json and urls.json after every change: each update is
+    a transaction that only touches the rows of one series, so several scrapers (threads or
+    processes) can work on different series at once. WAL mode keeps readers off the writers' backs.
+    export_json writes the same series.json / urls.json shapes as before, and import_json loads them.
+    '''
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def snapshot(cls, db_path):
+        '''
+        An in-memory copy of the catalog at db_path (empty if there is none), for dry runs:
+        nothing done to it is saved, and nothing at db_path is created or written.
+        '''
+        store = cls(':memory:')
+        if os.path.exists(db_path):
+            # immutable doesn't create the -shm / -wal files; it's only safe when no writer left a -wal behind
+            mode = 'mode=ro' if os.path.exists(f'{db_path}-wal') else 'immutable=1'
+            source = sqlite3.connect(f'file:{pathname2url(os.path.abspath(db_path))}?{mode}', uri=True)
+            try:
+                source.backup(store.connection)
+            finally:
+                source.close()
+            # a catalog from before a table was added
+            store.connection.executescript(SCHEMA)
+        return store
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_series(self, entries):
+        '''
+        Add the {'title', 'id'} entries that aren't in the catalog yet, after the existing ones.
+
+        :return: The number of series added.
+        '''
+        with self.lock, self.connection:
+            added = 0
+            for entry in entries:
+                cursor = self.connection.execute(
+                    '''INSERT INTO series (title, id, position)
+                       SELECT ?, ?, COALESCE(MAX(position) + 1, 0) FROM series WHERE true
+                       ON CONFLICT DO NOTHING''',
+                    (entry['title'], entry['id'])
+                )
+                if cursor.rowcount:
+                    added += 1
+                else:
+                    # known from its episodes before its id was
+                    self.connection.execute(
+                        'UPDATE series SET id = ? WHERE title = ? AND id IS NULL', (entry['id'], entry['title'])
+                    )
+            return added
+
+    def series(self):
+        '''Every series as {'title', 'id'}, in the order they were added (the series.json shape).'''
+        with self.lock:
+            rows = self.connection.execute('SELECT title, id FROM series ORDER BY position').fetchall()
+        return [{'title': title, 'id': id} for title, id in rows]
+
+    def set_episodes(self, series, episodes):
+        '''
+        Make the episode list of series match episodes ({'title', 'id'} dicts in site order).
+
+        Episodes that are already known keep their urls; only rows that are new, moved,
+        renamed or gone are written. An empty list is refused, as it would wipe the series.
+        '''
+        if not episodes:
+            raise ValueError(f"No episodes given for {series}")
+        with self.lock, self.connection:
+            self.connection.execute(
+                '''INSERT INTO series (title, id, position)
+                   SELECT ?, ?, COALESCE(MAX(position) + 1, 0) FROM series WHERE true
+                   ON CONFLICT DO NOTHING''',
+                (series, None)
+            )
+            self.connection.executemany(
+                '''INSERT INTO episodes (series, id, position, title) VALUES (?, ?, ?, ?)
+                   ON CONFLICT (series, id) DO UPDATE SET position = excluded.position, title = excluded.title
+                   WHERE position != excluded.position OR title != excluded.title''',
+                ((series, ep['id'], position, ep['title']) for position, ep in enumerate(episodes))
+            )
+            ids = [ep['id'] for ep in episodes]
+            self.connection.execute(
+                f'DELETE FROM episodes WHERE series = ? AND id NOT IN ({", ".join("?" * len(ids))})',
+                (series, *ids)
+            )
+
+    def set_urls(self, series, field, urls):
+        '''Set field ('xml_url' or 'stream_url') of the episodes of series from a dict of episode id -> url.'''
+        if field not in ('xml_url', 'stream_url'):
+            raise ValueError(f"Unknown url field: {field}")
+        with self.lock, self.connection:
+            self.connection.executemany(
+                f'UPDATE episodes SET {field} = ?, has_{field} = 1 WHERE series = ? AND id = ?',
+                ((url, series, ep_id) for ep_id, url in urls.items())
+            )
+
+    def episodes(self, series):
+        '''The episodes of series in order, as urls.json entries (urls that were never set are left out).'''
+        with self.lock:
+            rows = self.connection.execute(
+                f'SELECT {self.entry_columns} FROM episodes WHERE series = ? ORDER BY position', (series,)
+            ).fetchall()
+        return [self.episode_entry(*row) for row in rows]
+
+    entry_columns = 'title, id, xml_url, has_xml_url, stream_url, has_stream_url'
+
+    @staticmethod
+    def episode_entry(title, id, xml_url, has_xml_url, stream_url, has_stream_url):
+        entry = {'title': title, 'id': id}
+        if has_xml_url:
+            entry['xml_url'] = xml_url
+        if has_stream_url:
+            entry['stream_url'] = stream_url
+        return entry
+
+    def urls(self):
+        '''The whole catalog in the urls.json shape: {series title: [episode entries]}.'''
+        with self.lock:
+            rows = self.connection.execute(
+                f'''SELECT e.series, {', '.join('e.' + column for column in self.entry_columns.split(', '))}
+                   FROM episodes e JOIN series s ON s.title = e.series
+                   ORDER BY s.position, e.position'''
+            ).fetchall()
+        urls = {}
+        for series, *episode in rows:
+            urls.setdefault(series, []).append(self.episode_entry(*episode))
+        return urls
+
+    def import_json(self, urls_json=None, series_json=None):
+        '''Load an existing series.json and/or urls.json into the catalog.'''
+        if series_json:
+            with open(series_json, 'r') as f:
+                self.add_series(json.load(f))
+        if urls_json:
+            with open(urls_json, 'r') as f:
+                urls = json.load(f)
+            for series, episodes in urls.items():
+                if not episodes:
+                    continue
+                self.set_episodes(series, episodes)
+                for field in ('xml_url', 'stream_url'):
+                    self.set_urls(series, field, {ep['id']: ep[field] for ep in episodes if field in ep})
+
+    def json_file_changed(self, path):
+        '''Whether the json file at path exists and isn't the version last imported or exported.'''
+        if not path or not os.path.exists(path):
+            return False
+        stat = os.stat(path)
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT mtime_ns, size FROM json_files WHERE path = ?', (os.path.abspath(path),)
+            ).fetchone()
+        return row != (stat.st_mtime_ns, stat.st_size)
+
+    def record_json_file(self, path):
+        stat = os.stat(path)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO json_files (path, mtime_ns, size) VALUES (?, ?, ?)',
+                (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+            )
+
+    def sync_json(self, urls_json=None, series_json=None):
+        '''
+        Import series.json and/or urls.json if they changed since they were last imported or exported,
+        so edits to the json files reach the catalog (for the series and episodes they list).
+
+        :return: The paths imported.
+        '''
+        imported = []
+        if self.json_file_changed(series_json):
+            self.import_json(series_json=series_json)
+            self.record_json_file(series_json)
+            imported.append(series_json)
+        if self.json_file_changed(urls_json):
+            self.import_json(urls_json=urls_json)
+            self.record_json_file(urls_json)
+            imported.append(urls_json)
+        return imported
+
+    def export_json(self, urls_json=None, series_json=None):
+        '''Write the catalog out as series.json and/or urls.json, in the same format the scrapers used to write.'''
+        for path, data in ((series_json, self.series), (urls_json, self.urls)):
+            if path:
+                write_atomic(path, json.dumps(data(), indent=4))
+                # the catalog and the file agree, sync_json needn't import it back
+                self.record_json_file(path)
@@ -0,0 +1,239 @@
+import concurrent.futures
+import json
+import logging
+import os
+import shutil
+import subprocess
+from datetime import timedelta
+
+import srt
+
+from fileio import write_atomic
+from metrics import registry, Progress
+
+
+logger = logging.getLogger(__name__)
+
+MILLISECOND = timedelta(milliseconds=1)
+MEDIA_EXTENSIONS = ('mp4', 'm4a')
+
+
+def read_srt_cues(srt_path):
+    '''Read an SRT file into (index, start_ms, end_ms) tuples, sorted by start time.'''
+    with open(srt_path, 'r', encoding='utf-8') as f:
+        cues = [
+            (subtitle.index, subtitle.start // MILLISECOND, subtitle.end // MILLISECOND)
+            for subtitle in srt.parse(f.read())
+        ]
+    return sorted(cues, key=lambda cue: cue[1])
+
+
+def plan_segments(cues):
+    '''
+    Turn cues into the cut points of one segment muxer pass over the episode.
+
+    Every cue becomes one segment and the gaps between cues become segments that are thrown away.
+    A cue that runs into the next one is cut where the next one starts, and cues left empty by that are skipped.
+
+    :return: (cut points in ms, {segment number: cue index})
+    '''
+    boundaries = []
+    keep = {}
+    position = 0
+    for i, (index, start, end) in enumerate(cues):
+        if i + 1 < len(cues):
+            end = min(end, cues[i + 1][1])
+        if end <= start or start < position:
+            continue
+        if start > position:
+            boundaries.append(start)
+        keep[len(boundaries)] = index
+        boundaries.append(end)
+        position = end
+    return boundaries, keep
+
+
+def seconds_list(boundaries):
+    return ','.join(f'{ms / 1000:.3f}' for ms in boundaries)
+
+
+class ClipManifest:
+    '''
+    Records, for every episode whose clips were extracted, the mtime and size of its media and SRT,
+    whether the clips have video, and the clips written, so unchanged episodes are skipped.
+    Keys and clip paths are relative to the media directory.
+    '''
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.entries = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def signature(media_stat, srt_stat, video):
+        return [media_stat.st_mtime_ns, media_stat.st_size, srt_stat.st_mtime_ns, srt_stat.st_size, video]
+
+    def is_current(self, key, signature, base_directory):
+        entry = self.entries.get(key)
+        return bool(entry) and entry['signature'] == signature and all(
+            os.path.exists(os.path.join(base_directory, clip)) for clip in entry['clips']
+        )
+
+    def record(self, key, signature, clips):
+        self.entries[key] = {'signature': signature, 'clips': clips}
+
+    def save(self):
+        write_atomic(self.manifest_path, json.dumps(self.entries, indent=4))
+
+
+class ClipExtractor:
+    '''
+    Cuts every cue of the converted SRT files out of the episodes' downloaded media,
+    for listening flashcards: <series>/<ep>/clips/<cue index>.m4a (or .mp4 with video).
+
+    Each episode is read by a single ffmpeg process whose segment muxer splits it at the cue
+    boundaries, instead of one ffmpeg process (and one seek) per clip. Audio clips copy the AAC
+    stream without decoding it, so cuts fall on the nearest audio frame (~20 ms). Video clips are
+    encoded once, with keyframes forced at the cue boundaries so every clip starts on its cue.
+    Episodes run in parallel, one ffmpeg per worker.
+
+    Episodes whose media and SRT are unchanged since their clips were extracted (per the
+    .clips_manifest.json in the media directory) are skipped.
+    Subtitles come from subtitle_directory; media (from Downloader.download_mp4s) and the clips
+    live in media_directory, which defaults to the subtitle directory.
+    '''
+    manifest_filename = '.clips_manifest.json'
+    clips_dirname = 'clips'
+
+    def __init__(self, subtitle_directory, media_directory=None, video=False):
+        self.subtitle_directory = subtitle_directory
+        self.media_directory = media_directory or subtitle_directory
+        self.video = video
+
+    def find_episodes(self):
+        '''Return (srt path, media path) for every episode that has both a converted SRT and downloaded media.'''
+        episodes = []
+        for series in sorted(os.listdir(self.subtitle_directory)):
+            series_directory = os.path.join(self.subtitle_directory, series)
+            if not os.path.isdir(series_directory):
+                continue
+            for ep in sorted(os.listdir(series_directory)):
+                srt_path = os.path.join(series_directory, ep, f'{ep}.srt')
+                if not os.path.exists(srt_path):
+                    continue
+                for extension in MEDIA_EXTENSIONS:
+                    media_path = os.path.join(self.media_directory, series, ep, f'{ep}.{extension}')
+                    if os.path.exists(media_path):
+                        episodes.append((srt_path, media_path))
+                        break
+        return episodes
+
+    def segment_command(self, media_path, boundaries, output_pattern, video, threads=1):
+        command = [
+            "ffmpeg",
+            "-y",
+            "-loglevel", "error",
+            "-i", media_path,
+        ]
+        if video:
+            command += [
+                "-map", "0:v:0", "-map", "0:a:0?",
+                "-c:v", "libx264", "-preset", "veryfast", "-threads", str(threads),
+                "-force_key_frames", seconds_list(boundaries),
+                "-c:a", "aac",
+            ]
+        else:
+            command += ["-map", "0:a:0", "-vn", "-c:a", "copy"]
+        command += [
+            "-f", "segment",
+            "-segment_times", seconds_list(boundaries),
+            "-segment_format", "mp4",
+            "-reset_timestamps", "1",
+            output_pattern,
+        ]
+        return command
+
+    def extract_episode(self, srt_path, media_path, threads=1):
+        '''
+        Write the clips of one episode in a single ffmpeg pass and remove clips of cues that are gone.
+
+        :return: The paths of the clips.
+        '''
+        clips_directory = os.path.join(os.path.dirname(media_path), self.clips_dirname)
+        video = self.video and media_path.endswith('.mp4')
+        extension = 'mp4' if video else 'm4a'
+        boundaries, keep = plan_segments(read_srt_cues(srt_path))
+
+        # segments are written here first, then the cues' ones are renamed into place
+        tmp_directory = f'{clips_directory}.part'
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        os.makedirs(tmp_directory)
+        if keep:
+            output_pattern = os.path.join(tmp_directory, f'%05d.{extension}')
+            subprocess.run(self.segment_command(media_path, boundaries, output_pattern, video, threads), check=True)
+
+        os.makedirs(clips_directory, exist_ok=True)
+        clips = []
+        for number, index in keep.items():
+            segment_path = os.path.join(tmp_directory, f'{number:05d}.{extension}')
+            if not os.path.exists(segment_path):
+                # the cue starts after the end of the media
+                continue
+            clip_path = os.path.join(clips_directory, f'{index:04d}.{extension}')
+            os.replace(segment_path, clip_path)
+            clips.append(clip_path)
+        shutil.rmtree(tmp_directory)
+
+        names = {os.path.basename(clip) for clip in clips}
+        for name in os.listdir(clips_directory):
+            if name not in names:
+                os.remove(os.path.join(clips_directory, name))
+        return clips
+
+    def extract(self, max_workers=None, force=False):
+        '''Extract the clips of every new or changed episode, max_workers episodes (default: one per core) at once.
+
+        :return: The number of episodes extracted.
+        '''
+        max_workers = max_workers or os.cpu_count() or 1
+        # ffmpeg threads per episode, so parallel video encodes don't oversubscribe the cores
+        threads = max(1, (os.cpu_count() or 1) // max_workers)
+        manifest = ClipManifest(os.path.join(self.media_directory, self.manifest_filename))
+
+        tasks = []
+        for srt_path, media_path in self.find_episodes():
+            key = os.path.relpath(media_path, self.media_directory)
+            signature = ClipManifest.signature(os.stat(media_path), os.stat(srt_path), self.video)
+            if not force and manifest.is_current(key, signature, self.media_directory):
+                continue
+            tasks.append((srt_path, media_path, key, signature))
+
+        logger.info("Extracting clips of %d episodes", len(tasks))
+        progress = Progress(len(tasks), 'clips')
+        extracted = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(self.extract_episode_timed, srt_path, media_path, threads): (media_path, key, signature)
+                for srt_path, media_path, key, signature in tasks
+            }
+            for future in concurrent.futures.as_completed(futures):
+                media_path, key, signature = futures[future]
+                try:
+                    clips = future.result()
+                except (OSError, subprocess.CalledProcessError) as e:
+                    logger.warning("Failed to extract clips of %s: %s", media_path, e)
+                    progress.update(failed=True)
+                    continue
+                manifest.record(key, signature, [os.path.relpath(clip, self.media_directory) for clip in clips])
+                registry.inc('clips_extracted_total', len(clips))
+                extracted += 1
+                progress.update()
+        progress.close()
+
+        manifest.save()
+        return extracted
+
+    def extract_episode_timed(self, srt_path, media_path, threads=1):
+        with registry.timer('clips'):
+            return self.extract_episode(srt_path, media_path, threads)
@@ -0,0 +1,430 @@
+import concurrent.futures
+import glob
+import hashlib
+import json
+import fnmatch
+import logging
+import multiprocessing
+import os
+import re
+import time
+import xml.etree.ElementTree as ET
+from datetime import timedelta
+
+import srt
+
+from fileio import write_atomic
+from metrics import registry, Progress
+
+
+logger = logging.getLogger(__name__)
+
+
+# karaoke-style captions mark the word being read with [@...@]
+HIGHLIGHT_MARKER = re.compile(r'\[@|@\]')
+HIGHLIGHTED_WORD = re.compile(r'\[@(.*?)@\]')
+PINYIN_TONE = re.compile(r'[āáǎàēéěèīíǐìōóǒòūúǔùǖǘǚǜ]')
+HANZI = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]')
+MILLISECOND = timedelta(milliseconds=1)
+
+
+def sha256_file(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class ConversionManifest:
+    '''
+    Records, for every converted XML file, its mtime, size and sha256 together with the outputs
+    derived from it, so the Converter only has to redo files that are new or changed
+    and can clean up outputs whose XML was removed.
+    Keys and output paths are relative to the output directory.
+    '''
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.entries = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                self.entries = json.load(f)
+
+    def is_current(self, key, stat):
+        entry = self.entries.get(key)
+        return bool(entry) and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size
+
+    def has_digest(self, key, digest):
+        entry = self.entries.get(key)
+        return bool(entry) and entry['sha256'] == digest
+
+    def record(self, key, stat, digest, outputs=None):
+        if outputs is None:
+            outputs = self.entries[key]['outputs']
+        self.entries[key] = {
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'sha256': digest,
+            'outputs': outputs,
+        }
+
+    def pop_missing(self, keys, selected=None):
+        '''Remove and return the entries whose source is not in keys (only among the keys selected accepts, if given).'''
+        missing = [key for key in self.entries if key not in keys and (selected is None or selected(key))]
+        return {key: self.entries.pop(key) for key in missing}
+
+    def save(self):
+        write_atomic(self.manifest_path, json.dumps(self.entries, indent=4))
+
+
+class Converter:
+    '''
+    Converts the downloaded XML subtitles to SRT and TXT (and a word timing track for word-by-word captions).
+
+    series (series names or glob patterns) limits every method to those series' directories.
+    '''
+    manifest_filename = '.convert_manifest.json'
+
+    def __init__(self, output_directory, series=None):
+        self.output_directory = output_directory
+        self.series = [series] if isinstance(series, str) else series
+
+    def selected(self, key):
+        '''Whether a path relative to the output directory is in one of the selected series.'''
+        return self.series is None or any(
+            fnmatch.fnmatchcase(key.split(os.sep, 1)[0], pattern) for pattern in self.series
+        )
+
+    def find_xml_files(self):
+        '''Walk the output directory once and return the paths of all the XML subtitle files.'''
+        return list(self.scan_xml_files())
+
+    def scan_xml_files(self):
+        '''Walk the output directory once and return a dict of XML subtitle file path -> os.stat_result.'''
+        xml_stats = {}
+        with os.scandir(self.output_directory) as entries:
+            directories = [entry.path for entry in entries if entry.is_dir() and self.selected(entry.name)]
+        while directories:
+            with os.scandir(directories.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        directories.append(entry.path)
+                    elif entry.name.endswith('.xml'):
+                        xml_stats[entry.path] = entry.stat()
+        return xml_stats
+
+    def plan_conversion(self, manifest, xml_path, stat, force=False):
+        '''
+        Check xml_path against the manifest. Unchanged content under a new mtime is recorded as converted.
+
+        :return: (key, sha256) if the file has to be converted, else None.
+        '''
+        key = os.path.relpath(xml_path, self.output_directory)
+        if not force and manifest.is_current(key, stat):
+            return None
+        digest = sha256_file(xml_path)
+        if not force and manifest.has_digest(key, digest):
+            manifest.record(key, stat, digest)
+            return None
+        return key, digest
+
+    def record_conversion(self, manifest, key, stat, digest, outputs, timings):
+        # the workers are separate processes, so their stage timings are recorded here
+        for stage, seconds in timings.items():
+            registry.observe('stage_seconds', seconds, {'stage': stage})
+        outputs = [os.path.relpath(output, self.output_directory) for output in outputs]
+        manifest.record(key, stat, digest, outputs)
+        logger.debug("File converted successfully: %s", outputs[0])
+
+    def pending(self, force=False):
+        '''The XML files convert() would convert, without converting anything.'''
+        manifest = ConversionManifest(os.path.join(self.output_directory, self.manifest_filename))
+        return [
+            xml_path for xml_path, stat in self.scan_xml_files().items()
+            if self.plan_conversion(manifest, xml_path, stat, force)
+        ]
+
+    def convert(self, max_workers=None, force=False):
+        '''Convert new or changed XML subtitle files to SRT and TXT, spread over a process pool.
+
+        Replaces running xml_to_srt followed by srt_to_txt: each XML file is parsed once
+        and both outputs are written from the same cues. Files recorded in the conversion
+        manifest with the same mtime and size (or content hash) are skipped unless force is set,
+        and outputs of XML files that disappeared are deleted.
+        A file that can't be converted is logged and left out of the manifest, so the next run
+        tries it again; the manifest is saved even if the run is interrupted.
+
+        :return: The number of files converted.
+        '''
+        manifest = ConversionManifest(os.path.join(self.output_directory, self.manifest_filename))
+        xml_stats = self.scan_xml_files()
+
+        to_convert = []
+        for xml_path, stat in xml_stats.items():
+            planned = self.plan_conversion(manifest, xml_path, stat, force)
+            if planned:
+                to_convert.append((xml_path, stat, *planned))
+
+        keys = {os.path.relpath(xml_path, self.output_directory) for xml_path in xml_stats}
+        for key, entry in manifest.pop_missing(keys, self.selected).items():
+            for output in entry['outputs']:
+                output_path = os.path.join(self.output_directory, output)
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+            logger.info("Removed outputs of deleted file: %s", key)
+
+        logger.info("Converting %d of %d files", len(to_convert), len(xml_stats))
+        progress = Progress(len(to_convert), 'convert')
+        converted = failed = 0
+        # spawned, not forked: forking copies the locks of whatever threads the caller has running (the downloads)
+        mp_context = multiprocessing.get_context('spawn')
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+                chunksize = max(1, len(to_convert) // ((max_workers or os.cpu_count() or 1) * 4))
+                xml_paths = [xml_path for xml_path, _, _, _ in to_convert]
+                results = executor.map(self.try_convert_file, xml_paths, chunksize=chunksize)
+                for (xml_path, stat, key, digest), (outputs, timings, error) in zip(to_convert, results):
+                    if error:
+                        logger.warning("Failed to convert %s: %s", xml_path, error)
+                        failed += 1
+                    else:
+                        self.record_conversion(manifest, key, stat, digest, outputs, timings)
+                        converted += 1
+                    progress.update(failed=bool(error))
+        finally:
+            progress.close()
+            manifest.save()
+            self.record_totals(converted, failed)
+        return converted
+
+    def convert_as_available(self, xml_paths, max_workers=None, force=False):
+        '''
+        Convert XML files as the xml_paths iterable yields them (e.g. as their downloads finish),
+        so conversion runs alongside the download instead of after it.
+        Files are skipped per the manifest as in convert; outputs of deleted files are left alone.
+        Failed files are logged and skipped as in convert.
+
+        :return: The number of files converted.
+        '''
+        manifest = ConversionManifest(os.path.join(self.output_directory, self.manifest_filename))
+        futures = {}
+        converted = failed = 0
+        # spawned, not forked: the caller usually has download threads running
+        mp_context = multiprocessing.get_context('spawn')
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+                for xml_path in xml_paths:
+                    stat = os.stat(xml_path)
+                    planned = self.plan_conversion(manifest, xml_path, stat, force)
+                    if planned:
+                        futures[executor.submit(self.try_convert_file, xml_path)] = (xml_path, stat, *planned)
+                for future in concurrent.futures.as_completed(futures):
+                    xml_path, stat, key, digest = futures[future]
+                    outputs, timings, error = future.result()
+                    if error:
+                        logger.warning("Failed to convert %s: %s", xml_path, error)
+                        failed += 1
+                        continue
+                    self.record_conversion(manifest, key, stat, digest, outputs, timings)
+                    converted += 1
+        finally:
+            manifest.save()
+            self.record_totals(converted, failed)
+        return converted
+
+    def record_totals(self, converted, failed):
+        registry.inc('files_converted_total', converted)
+        registry.inc('files_convert_failed_total', failed)
+        if failed:
+            logger.warning("%d files failed to convert, they are retried on the next run", failed)
+
+    def convert_file(self, xml_path):
+        '''Convert one XML subtitle file to SRT and TXT next to it.
+
+        :return: The paths of the written SRT and TXT files.
+        '''
+        return self.convert_file_timed(xml_path)[0]
+
+    def try_convert_file(self, xml_path):
+        '''convert_file_timed for the process pool: an error fails only this file.
+
+        :return: (output paths, {stage: seconds}, None) or (None, None, the error message)
+        '''
+        try:
+            return (*self.convert_file_timed(xml_path), None)
+        except Exception as e:
+            # e.g. a truncated download (ET.ParseError) or a paragraph without timings
+            return None, None, f'{type(e).__name__}: {e}'
+
+    def convert_file_timed(self, xml_path):
+        '''convert_file that also returns how long its parse, compose and write stages took.
+
+        :return: (output paths, {stage: seconds})
+        '''
+        timings = {}
+        start = time.perf_counter()
+        base_path = os.path.splitext(xml_path)[0]
+        cues = self.read_cues(xml_path)
+
+        words = None
+        if any("[@" in text for _, _, text in cues):
+            subtitles, words = self.collapse_word_by_word(cues)
+        else:
+            subtitles = [
+                srt.Subtitle(index=i, start=start * MILLISECOND, end=end * MILLISECOND, content=text)
+                for i, (start, end, text) in enumerate(cues, 1)
+            ]
+        timings['parse'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        # sort_and_reindex drops the same empty cues srt.compose would, so the TXT matches the SRT
+        subtitles = list(srt.sort_and_reindex(subtitles))
+        srt_content = srt.compose(subtitles, reindex=False)
+        txt_content = ''.join(srt.make_legal_content(subtitle.content) + '\n' for subtitle in subtitles)
+        timings['compose'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        outputs = [base_path + '.srt', base_path + '.txt']
+        write_atomic(outputs[0], srt_content, encoding='utf-8')
+        write_atomic(outputs[1], txt_content, encoding='utf-8')
+        if words is not None:
+            outputs.append(base_path + '.words.tsv')
+            write_atomic(outputs[2], self.compose_words(words), encoding='utf-8')
+        timings['write'] = time.perf_counter() - start
+
+        return outputs, timings
+
+    def read_cues(self, xml_path):
+        '''Stream the <Paragraph> elements of an XML subtitle file into (start_ms, end_ms, text) tuples.'''
+        cues = []
+        for _, element in ET.iterparse(xml_path):
+            if element.tag != 'Paragraph':
+                continue
+            cues.append((
+                int(element.findtext('StartMilliseconds')),
+                int(element.findtext('EndMilliseconds')),
+                element.findtext('Text') or '',
+            ))
+            element.clear()
+        return cues
+
+    def parse_xml(self, xml_path):
+        '''Stream the <Paragraph> elements of an XML subtitle file into srt.Subtitle cues.'''
+        return [
+            srt.Subtitle(index=i, start=start * MILLISECOND, end=end * MILLISECOND, content=text)
+            for i, (start, end, text) in enumerate(self.read_cues(xml_path), 1)
+        ]
+    
+    def xml_to_srt(self):
+        '''Convert XML subtitle files to SRT format.'''
+        from bs4 import BeautifulSoup
+
+        def ms_to_timedelta(ms):
+            return timedelta(milliseconds=int(ms))
+    
+        for root, _, _ in os.walk(self.output_directory):
+            for file in glob.glob(os.path.join(root, '*.xml')):
+                xml_path = file
+                srt_path = os.path.splitext(xml_path)[0] + '.srt'
+    
+                with open(xml_path, 'r', encoding='utf-8') as file:
+                    soup = BeautifulSoup(file, 'xml')
+    
+                subtitles = []
+    
+                paragraphs = soup.find_all('Paragraph')
+                for paragraph in paragraphs:
+                    start = ms_to_timedelta(paragraph.find('StartMilliseconds').text)
+                    end = ms_to_timedelta(paragraph.find('EndMilliseconds').text)
+                    text = paragraph.find('Text').text
+
+                    subtitles.append(srt.Subtitle(index=len(subtitles) + 1, start=start, end=end, content=text))
+    
+                word_by_word = False
+                for subtitle in subtitles:
+                    if "[@" in subtitle.content:
+                        word_by_word = True
+                        break
+
+                if word_by_word:
+                    subtitles = self.correct_word_by_word_subtitles(subtitles)
+
+                with open(srt_path, 'w', encoding='utf-8') as file: 
+                    file.write(srt.compose(subtitles))
+    
+                logger.debug("File converted successfully: %s", srt_path)
+            
+    def correct_word_by_word_subtitles(self, subtitles):
+        cues = ((subtitle.start // MILLISECOND, subtitle.end // MILLISECOND, subtitle.content) for subtitle in subtitles)
+        return self.collapse_word_by_word(cues)[0]
+
+    def collapse_word_by_word(self, cues):
+        '''
+        Collapse the (start_ms, end_ms, text) cues of a karaoke-style caption file in one pass.
+
+        These files repeat every sentence once per word, with the word being read wrapped in [@...@]
+        on both the pinyin and the hanzi line. Runs of cues with the same text become one sentence cue
+        (pinyin line removed) spanning the whole run, and every highlighted cue becomes a word timing.
+
+        :return: (sentences as srt.Subtitle cues, word timings as (start_ms, end_ms, hanzi, pinyin) tuples)
+        '''
+        sentences = []
+        words = []
+        content = start = end = None
+
+        for cue_start, cue_end, text in cues:
+            if '[@' in text:
+                # plain text and highlighted words alternate: [text, word, text, word, ..., text]
+                parts = HIGHLIGHTED_WORD.split(text)
+                if len(parts) == 5:
+                    # the usual case: one word highlighted on the pinyin line and one on the hanzi line
+                    pinyin, word = parts[1], parts[3]
+                    if HANZI.search(pinyin):
+                        pinyin, word = word, pinyin
+                else:
+                    highlighted = parts[1::2]
+                    word = ''.join(token for token in highlighted if HANZI.search(token))
+                    pinyin = ' '.join(token for token in highlighted if not HANZI.search(token))
+                words.append((cue_start, cue_end, word, pinyin))
+                text = ''.join(parts)
+                if '[@' in text or '@]' in text:
+                    # an unpaired marker
+                    text = HIGHLIGHT_MARKER.sub('', text)
+
+            if text != content:
+                if content is not None:
+                    sentences.append(srt.Subtitle(index=len(sentences) + 1, start=start * MILLISECOND,
+                                                  end=end * MILLISECOND, content=self.remove_pinyin_line(content)))
+                content = text
+                start = cue_start
+            end = cue_end
+
+        if content is not None:
+            sentences.append(srt.Subtitle(index=len(sentences) + 1, start=start * MILLISECOND,
+                                          end=end * MILLISECOND, content=self.remove_pinyin_line(content)))
+        return sentences, words
+
+    def compose_words(self, words):
+        '''The word timing track: a tab separated start_ms, end_ms, hanzi, pinyin line per word.'''
+        lines = ['start_ms\tend_ms\tword\tpinyin']
+        for start, end, word, pinyin in words:
+            lines.append(f'{start}\t{end}\t{word}\t{pinyin}')
+        return '\n'.join(lines) + '\n'
+
+    def remove_pinyin_line(self, content):
+        return '\n'.join(line for line in content.split('\n') if not PINYIN_TONE.search(line)).strip()
+
+    def srt_to_txt(self):
+        '''Convert SRT subtitle files to plain text.'''
+        for root, _, _ in os.walk(self.output_directory):
+            for file in glob.glob(os.path.join(root, '*.srt')):
+                srt_path = file
+                txt_path = os.path.splitext(srt_path)[0] + '.txt'
+    
+                with open(srt_path, 'r', encoding='utf-8') as file:
+                    srt_content = file.read()
+
+                subtitles = list(srt.parse(srt_content))
+
+                with open(txt_path, 'w', encoding='utf-8') as file:
+                    for subtitle in subtitles:
+                        file.write(subtitle.content + '\n')
+
+                logger.debug("File converted successfully: %s", txt_path)
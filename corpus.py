@@ -0,0 +1,188 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+from datetime import timedelta
+
+import srt
+
+from fileio import open_atomic
+
+
+MAGIC = b'LFCC'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIIII')
+HEADER_SIZE = 32
+SERIES_FIELDS = 4   # name_offset, name_length, first_episode, episode_count
+EPISODE_FIELDS = 5  # name_offset, name_length, series_index, first_cue, cue_count
+
+
+def episode_sort_key(ep_name):
+    '''Episode directories are named '<number>_<title>', sort them by number.'''
+    number = ep_name.split('_', 1)[0]
+    return (int(number) if number.isdigit() else sys.maxsize, ep_name)
+
+
+def pad4(data):
+    return data + b'\0' * (-len(data) % 4)
+
+
+def build_corpus(subtitle_directory, corpus_path, annotated=False):
+    '''
+    Pack every converted .srt under subtitle_directory into one corpus file.
+    With annotated set, episodes annotated by annotate.Annotator are packed from their .annotated.srt,
+    so each cue's text is its space-separated words plus a line of their pinyin.
+
+    Layout (little-endian uint32 throughout, sections 4-byte aligned):
+    header, series table, episode table, cue start_ms, cue end_ms,
+    cue text offsets (n_cues + 1 entries into the text blob), names blob, UTF-8 text blob.
+    '''
+    series_table = array('I')
+    episode_table = array('I')
+    start_ms = array('I')
+    end_ms = array('I')
+    text_offsets = array('I', [0])
+    names = bytearray()
+    text = bytearray()
+
+    def add_name(name):
+        encoded = name.encode('utf-8')
+        offset = len(names)
+        names.extend(encoded)
+        return offset, len(encoded)
+
+    series_names = sorted(
+        entry.name for entry in os.scandir(subtitle_directory) if entry.is_dir()
+    )
+    for series_index, series in enumerate(series_names):
+        series_dir = os.path.join(subtitle_directory, series)
+        ep_names = sorted((entry.name for entry in os.scandir(series_dir) if entry.is_dir()), key=episode_sort_key)
+        series_table.extend(add_name(series) + (len(episode_table) // EPISODE_FIELDS, len(ep_names)))
+
+        for ep in ep_names:
+            srt_path = os.path.join(series_dir, ep, f'{ep}.srt')
+            if annotated and os.path.exists(os.path.join(series_dir, ep, f'{ep}.annotated.srt')):
+                srt_path = os.path.join(series_dir, ep, f'{ep}.annotated.srt')
+            subtitles = []
+            if os.path.exists(srt_path):
+                with open(srt_path, 'r', encoding='utf-8') as f:
+                    subtitles = list(srt.parse(f.read()))
+
+            episode_table.extend(add_name(ep) + (series_index, len(start_ms), len(subtitles)))
+            for subtitle in subtitles:
+                start_ms.append(subtitle.start // timedelta(milliseconds=1))
+                end_ms.append(subtitle.end // timedelta(milliseconds=1))
+                text.extend(subtitle.content.encode('utf-8'))
+                text_offsets.append(len(text))
+
+    for table in (series_table, episode_table, start_ms, end_ms, text_offsets):
+        if sys.byteorder != 'little':
+            table.byteswap()
+
+    header = HEADER.pack(MAGIC, VERSION, len(series_names), len(episode_table) // EPISODE_FIELDS,
+                         len(start_ms), len(names), len(text))
+    # written section by section, so the packed corpus is never copied into one buffer
+    with open_atomic(corpus_path, 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b'\0'))
+        for table in (series_table, episode_table, start_ms, end_ms, text_offsets):
+            f.write(table)
+        f.write(pad4(bytes(names)))
+        f.write(text)
+
+
+class CorpusStore:
+    '''
+    Read-only view of a corpus file built by build_corpus.
+
+    The file is memory-mapped and the tables are exposed as zero-copy uint32 memoryviews,
+    so opening it costs the same no matter how many cues it holds.
+    Python objects (strings, tuples) are only created for the cues that are actually read.
+    '''
+    def __init__(self, corpus_path):
+        if sys.byteorder != 'little':
+            raise RuntimeError("CorpusStore reads little-endian tables in place and needs a little-endian machine")
+
+        self.file = open(corpus_path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = view = memoryview(self.mmap)
+
+        magic, version, n_series, n_episodes, n_cues, names_size, text_size = HEADER.unpack_from(view)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{corpus_path} is not a version {VERSION} corpus file")
+
+        offset = HEADER_SIZE
+
+        def take(count):
+            nonlocal offset
+            section = view[offset:offset + count * 4].cast('I')
+            offset += count * 4
+            return section
+
+        self.series_table = take(n_series * SERIES_FIELDS)
+        self.episode_table = take(n_episodes * EPISODE_FIELDS)
+        self.start_ms = take(n_cues)
+        self.end_ms = take(n_cues)
+        self.text_offsets = take(n_cues + 1)
+        self.names = view[offset:offset + names_size]
+        offset += names_size + (-names_size % 4)
+        self.text_blob = view[offset:offset + text_size]
+
+        self.series_count = n_series
+        self.episode_count = n_episodes
+        self._episode_index = None
+
+    def __len__(self):
+        return len(self.start_ms)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for view in (self.series_table, self.episode_table, self.start_ms, self.end_ms,
+                     self.text_offsets, self.names, self.text_blob, self.view):
+            view.release()
+        self.mmap.close()
+        self.file.close()
+
+    def name(self, offset, length):
+        return str(self.names[offset:offset + length], 'utf-8')
+
+    def series(self):
+        '''Names of all the series, in table order.'''
+        table = self.series_table
+        return [self.name(table[i * SERIES_FIELDS], table[i * SERIES_FIELDS + 1]) for i in range(self.series_count)]
+
+    def episode(self, episode_index):
+        '''(series name, episode name, first cue, cue count) of an episode.'''
+        name_offset, name_length, series_index, first_cue, cue_count = \
+            self.episode_table[episode_index * EPISODE_FIELDS:(episode_index + 1) * EPISODE_FIELDS]
+        series_offset, series_length = self.series_table[series_index * SERIES_FIELDS:series_index * SERIES_FIELDS + 2]
+        return self.name(series_offset, series_length), self.name(name_offset, name_length), first_cue, cue_count
+
+    def find_episode(self, series, ep_name):
+        '''Index of the episode, or None. The name index is built on first use.'''
+        if self._episode_index is None:
+            self._episode_index = {}
+            for i in range(self.episode_count):
+                series_name, name, _, _ = self.episode(i)
+                self._episode_index[(series_name, name)] = i
+        return self._episode_index.get((series, ep_name))
+
+    def episode_cues(self, series, ep_name):
+        '''range of the cue indexes of an episode (empty if it isn't in the corpus).'''
+        episode_index = self.find_episode(series, ep_name)
+        if episode_index is None:
+            return range(0)
+        _, _, first_cue, cue_count = self.episode(episode_index)
+        return range(first_cue, first_cue + cue_count)
+
+    def text(self, cue):
+        return str(self.text_blob[self.text_offsets[cue]:self.text_offsets[cue + 1]], 'utf-8')
+
+    def cue(self, cue):
+        '''(start_ms, end_ms, text) of a cue.'''
+        return self.start_ms[cue], self.end_ms[cue], self.text(cue)
@@ -1,7 +1,13 @@
+import logging
+import os
+
+from metrics import registry
 from utils import Downloader, Converter
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(name)s: %(message)s')
+
     output_directory = 'subtitles'
     urls_json = 'data/urls.json'
 
@@ -11,5 +17,6 @@ if __name__ == "__main__":
 
     # convert xml subs to srt and txt
     converter = Converter(output_directory)
-    converter.xml_to_srt()
-    converter.srt_to_txt()
\ No newline at end of file
+    converter.convert()
+
+    registry.write(os.path.join(output_directory, '.metrics.json'))
@@ -0,0 +1,47 @@
+import argparse
+import logging
+import os
+
+from hls import RenditionPreference
+from utils import Downloader
+from workqueue import WorkQueue
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download mp4s with any number of workers sharing one queue")
+    parser.add_argument('--queue', default='subtitles/.mp4_queue.sqlite3', help="queue database, on a filesystem all workers share")
+    parser.add_argument('--output', default='subtitles', help="output directory")
+    parser.add_argument('--shared-filesystem', action='store_true',
+                        help="workers on several machines: use the rollback journal instead of WAL")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    queue_parser = subparsers.add_parser('queue', help="add an mp4 job for every selected episode")
+    queue_parser.add_argument('--urls-json', default='data/urls.json')
+    queue_parser.add_argument('--series', nargs='*', help="series names or glob patterns")
+    queue_parser.add_argument('--episodes', help="episode spec, e.g. '1-10,15'")
+    queue_parser.add_argument('--max-height', type=int, help="best rendition of at most this many lines")
+    queue_parser.add_argument('--max-bandwidth', type=int, help="best rendition of at most this many bits per second")
+    queue_parser.add_argument('--audio-only', action='store_true', help="keep only the audio, as .m4a")
+
+    work_parser = subparsers.add_parser('work', help="claim and download jobs until the queue is drained")
+    work_parser.add_argument('--threads', type=int, default=4, help="episodes downloaded at once")
+    work_parser.add_argument('--lease', type=float, default=120, help="seconds before a silent worker's job is handed out again")
+
+    status_parser = subparsers.add_parser('status', help="print the number of jobs in every state")
+    status_parser.add_argument('--retry-failed', action='store_true', help="queue the failed jobs again")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    os.makedirs(os.path.dirname(args.queue) or '.', exist_ok=True)
+    work_queue = WorkQueue(args.queue, lease_seconds=getattr(args, 'lease', 120), wal=not args.shared_filesystem)
+    if args.command == 'queue':
+        rendition = RenditionPreference(args.max_height, args.max_bandwidth, args.audio_only)
+        downloader = Downloader(args.urls_json, args.output, series=args.series, episodes=args.episodes, rendition=rendition)
+        print(f"Queued {downloader.queue_mp4s(work_queue)} jobs")
+    elif args.command == 'work':
+        Downloader(None, args.output, wal=not args.shared_filesystem).work(work_queue, threads=args.threads)
+    else:
+        if args.retry_failed:
+            print(f"Queued {work_queue.retry_failed()} failed jobs again")
+        print(work_queue.counts())
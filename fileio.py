@@ -0,0 +1,26 @@
+import contextlib
+import os
+
+
+@contextlib.contextmanager
+def open_atomic(path, mode='w', encoding=None):
+    '''
+    Open a temporary file next to path for writing and rename it into place once the block is done,
+    so path is either the old file or the complete new one, never a truncated write.
+    If the block raises, the temporary file is removed and path is left alone.
+    '''
+    tmp_path = f'{path}.part'
+    try:
+        with open(tmp_path, mode, encoding=encoding) as f:
+            yield f
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def write_atomic(path, content, mode='w', encoding=None):
+    '''Write content (str, or bytes with mode='wb') to path with open_atomic.'''
+    with open_atomic(path, mode, encoding) as f:
+        f.write(content)
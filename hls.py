@@ -0,0 +1,299 @@
+import concurrent.futures
+import logging
+import os
+import re
+import shutil
+import subprocess
+import time
+from urllib.parse import urljoin
+
+import requests
+
+from fileio import write_atomic
+from metrics import registry
+from scheduler import VIDEO
+
+
+logger = logging.getLogger(__name__)
+
+
+URI_ATTRIBUTE = re.compile(r'URI="([^"]+)"')
+
+# the cdn keeps each rendition of a stream under /hls/<height>/..., the scraped urls point at 1080
+RENDITION_PATH = re.compile(r'/hls/(\d+)/')
+RENDITION_HEIGHTS = (1080, 720, 480, 360, 240)
+
+VIDEO_CODECS = ('avc', 'hvc', 'hev', 'vp8', 'vp09', 'av01')
+
+
+class SegmentError(Exception):
+    pass
+
+
+def media_is_complete(path):
+    '''
+    Whether ffmpeg reads the media file at path from start to end without an error,
+    e.g. not an mp4 an interrupted ffmpeg left without its moov atom or cut off mid-stream.
+    '''
+    result = subprocess.run(
+        ["ffmpeg", "-v", "error", "-i", path, "-map", "0", "-c", "copy", "-f", "null", "-"],
+        capture_output=True, text=True
+    )
+    return result.returncode == 0 and not result.stderr.strip()
+
+
+def parse_attributes(line):
+    '''Parse the attribute list of an #EXT-X-... tag into a dict.'''
+    attributes = {}
+    for match in re.finditer(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', line.split(':', 1)[1]):
+        attributes[match.group(1)] = match.group(2).strip('"')
+    return attributes
+
+
+def parse_playlist(text, base_url):
+    '''
+    Parse an m3u8 playlist.
+
+    :return: A dict with 'variants' (master playlists: attributes plus absolute 'url'),
+             'media' (master playlists: #EXT-X-MEDIA attributes, with an absolute 'url' if they have a URI),
+             'segments' (media playlists: absolute segment urls in order) and 'lines',
+             the playlist lines with every uri (segments, keys, init maps) resolved against base_url.
+    '''
+    variants = []
+    media = []
+    segments = []
+    lines = []
+    pending_variant = None
+
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            if line.startswith('#EXT-X-STREAM-INF'):
+                pending_variant = parse_attributes(line)
+            elif line.startswith('#EXT-X-MEDIA:'):
+                attributes = parse_attributes(line)
+                if 'URI' in attributes:
+                    attributes['url'] = urljoin(base_url, attributes['URI'])
+                media.append(attributes)
+            line = URI_ATTRIBUTE.sub(lambda m: f'URI="{urljoin(base_url, m.group(1))}"', line)
+            lines.append(line)
+            continue
+
+        url = urljoin(base_url, line)
+        if pending_variant is not None:
+            pending_variant['url'] = url
+            variants.append(pending_variant)
+            pending_variant = None
+        else:
+            segments.append(url)
+        lines.append(url)
+
+    return {'variants': variants, 'media': media, 'segments': segments, 'lines': lines}
+
+
+def master_renditions(playlist):
+    '''
+    The renditions a master playlist offers, as dicts of 'url', 'height', 'bandwidth' and 'audio_only'.
+    Audio-only variants and #EXT-X-MEDIA audio renditions count as audio only.
+    '''
+    renditions = []
+    for variant in playlist['variants']:
+        resolution = variant.get('RESOLUTION')
+        codecs = variant.get('CODECS', '')
+        renditions.append({
+            'url': variant['url'],
+            'height': int(resolution.split('x')[1]) if resolution else 0,
+            'bandwidth': int(variant.get('BANDWIDTH', 0)),
+            'audio_only': not resolution and bool(codecs) and not any(codec in codecs for codec in VIDEO_CODECS),
+        })
+    for media in playlist['media']:
+        if media.get('TYPE') == 'AUDIO' and 'url' in media:
+            renditions.append({'url': media['url'], 'height': 0, 'bandwidth': 0, 'audio_only': True})
+    return renditions
+
+
+class RenditionPreference:
+    '''
+    Which rendition of a stream to download.
+
+    max_height / max_bandwidth (lines / bits per second): the best rendition within both limits,
+    or the smallest one if none fits. audio_only: an audio rendition if the stream has one,
+    otherwise the smallest video rendition, and the video is dropped when remuxing to .m4a.
+    With no limits the best rendition is taken, as before.
+    '''
+    def __init__(self, max_height=None, max_bandwidth=None, audio_only=False):
+        self.max_height = max_height
+        self.max_bandwidth = max_bandwidth
+        self.audio_only = audio_only
+
+    @property
+    def extension(self):
+        return 'm4a' if self.audio_only else 'mp4'
+
+    def to_dict(self):
+        return {'max_height': self.max_height, 'max_bandwidth': self.max_bandwidth, 'audio_only': self.audio_only}
+
+    def fits(self, rendition):
+        return (self.max_height is None or rendition['height'] <= self.max_height) and \
+            (self.max_bandwidth is None or rendition['bandwidth'] <= self.max_bandwidth)
+
+    def choose(self, renditions):
+        if self.audio_only:
+            audio = [rendition for rendition in renditions if rendition['audio_only']]
+            if audio:
+                return max(audio, key=lambda r: r['bandwidth'])
+        video = [rendition for rendition in renditions if not rendition['audio_only']] or renditions
+        fitting = [rendition for rendition in video if self.fits(rendition)]
+        if fitting and not self.audio_only:
+            return max(fitting, key=lambda r: (r['bandwidth'], r['height']))
+        return min(video, key=lambda r: (r['height'], r['bandwidth']))
+
+    def candidate_heights(self, current):
+        '''The /hls/<height>/ siblings of a media playlist worth probing, most preferred first.'''
+        if self.audio_only:
+            return sorted(RENDITION_HEIGHTS)
+        if self.max_height is None or current <= self.max_height:
+            return []
+        return [height for height in RENDITION_HEIGHTS if height <= self.max_height]
+
+
+class HLSDownloader:
+    '''
+    Downloads an HLS stream segment by segment and remuxes it to mp4 with a local ffmpeg.
+
+    Segments are fetched in parallel as VIDEO jobs on the scheduler shared by every download,
+    each one is checked against its Content-Length and kept on disk in '<output>.segments/',
+    so an interrupted download resumes from the segments it already has. The directory records
+    the urls of its segments, and segments of another rendition or playlist are thrown away.
+    The mp4 is written under a temporary name and renamed only once ffmpeg succeeds,
+    so a file at the output path is always complete.
+
+    The rendition is picked by a RenditionPreference: from the variants of a master playlist,
+    or, for a plain media playlist, by probing the same stream under the cdn's other /hls/<height>/ paths.
+    '''
+    def __init__(self, transport, scheduler, rendition=None):
+        self.transport = transport
+        self.scheduler = scheduler
+        self.rendition = rendition or RenditionPreference()
+
+    def fetch_media_playlist(self, m3u8_url, rendition=None):
+        '''
+        Fetch the media playlist of the preferred rendition of m3u8_url.
+
+        :return: (parsed media playlist, height of the rendition or None if unknown,
+                  whether the video has to be dropped when remuxing)
+        '''
+        rendition = rendition or self.rendition
+        playlist = parse_playlist(self.transport.get(m3u8_url).text, m3u8_url)
+        renditions = master_renditions(playlist)
+        if renditions:
+            choice = rendition.choose(renditions)
+            playlist = parse_playlist(self.transport.get(choice['url']).text, choice['url'])
+            return playlist, choice['height'], rendition.audio_only and not choice['audio_only']
+
+        match = RENDITION_PATH.search(m3u8_url)
+        if not match:
+            return playlist, None, rendition.audio_only
+        current = int(match.group(1))
+        for height in rendition.candidate_heights(current):
+            if height == current:
+                break
+            url = RENDITION_PATH.sub(f'/hls/{height}/', m3u8_url, count=1)
+            try:
+                response = self.transport.get(url)
+            except requests.HTTPError:
+                continue
+            return parse_playlist(response.text, url), height, rendition.audio_only
+        return playlist, current, rendition.audio_only
+
+    def fetch_segment(self, url, path):
+        '''Download one segment (or key / init map) to path, retrying truncated bodies.'''
+        for attempt in range(self.transport.retries + 1):
+            response = self.transport.get(url)
+            content = response.content
+            expected = response.headers.get('Content-Length')
+            if expected is None or int(expected) == len(content):
+                break
+            if attempt == self.transport.retries:
+                raise SegmentError(f"{url}: expected {expected} bytes, got {len(content)}")
+            time.sleep(self.transport.backoff(attempt))
+
+        write_atomic(path, content, 'wb')
+        registry.inc('hls_segments_total')
+
+    def download(self, m3u8_url, output_path, rendition=None):
+        '''Download the preferred rendition (see RenditionPreference) of the stream at m3u8_url and remux it to output_path.'''
+        playlist, height, drop_video = self.fetch_media_playlist(m3u8_url, rendition)
+        registry.inc('hls_renditions_total', labels={'height': height, 'audio_only': drop_video or height == 0})
+
+        # every uri in the playlist (segments, keys, init maps) gets a local file name
+        local_names = {}
+        local_lines = []
+        for line in playlist['lines']:
+            if line.startswith('#'):
+                match = URI_ATTRIBUTE.search(line)
+                if match:
+                    url = match.group(1)
+                    local_names.setdefault(url, f'{len(local_names):05d}.bin')
+                    line = line.replace(match.group(0), f'URI="{local_names[url]}"')
+            else:
+                local_names.setdefault(line, f'{len(local_names):05d}.ts')
+                line = local_names[line]
+            local_lines.append(line)
+
+        # resume only from segments of this very playlist, e.g. not of a rendition picked by an earlier run
+        segment_dir = f'{output_path}.segments'
+        source_path = os.path.join(segment_dir, 'source.txt')
+        source = ''.join(f'{url}\n' for url in local_names)
+        if os.path.isdir(segment_dir):
+            previous = None
+            if os.path.exists(source_path):
+                with open(source_path, 'r') as f:
+                    previous = f.read()
+            if previous != source:
+                logger.debug("%s: discarding the segments of another playlist", output_path)
+                shutil.rmtree(segment_dir)
+        os.makedirs(segment_dir, exist_ok=True)
+        with open(source_path, 'w') as f:
+            f.write(source)
+
+        futures = []
+        for url, name in local_names.items():
+            path = os.path.join(segment_dir, name)
+            if not os.path.exists(path):
+                futures.append(self.scheduler.submit(VIDEO, self.fetch_segment, url, path))
+        logger.debug("%s: fetching %d of %d segments", output_path, len(futures), len(local_names))
+        registry.inc('hls_segments_resumed_total', len(local_names) - len(futures))
+        # let every segment finish before reporting a failure, so a retry resumes from all of them
+        concurrent.futures.wait(futures)
+        for future in futures:
+            future.result()
+
+        local_playlist = os.path.join(segment_dir, 'local.m3u8')
+        with open(local_playlist, 'w') as f:
+            f.write('\n'.join(local_lines) + '\n')
+
+        with registry.timer('remux'):
+            self.remux(local_playlist, output_path, drop_video)
+        shutil.rmtree(segment_dir)
+
+    def remux(self, local_playlist, output_path, drop_video=False):
+        tmp_path = f'{output_path}.part'
+        command = [
+            "ffmpeg",
+            "-y",
+            "-loglevel", "error",  # Suppress all but error messages
+            "-allowed_extensions", "ALL",
+            "-protocol_whitelist", "file,crypto",
+            "-i", local_playlist,  # Local playlist pointing at the downloaded segments
+            "-c", "copy",          # Copy codec (avoid re-encoding)
+            "-bsf:a", "aac_adtstoasc",  # Bitstream filter for audio
+        ]
+        if drop_video:
+            command.append("-vn")
+        command += ["-f", "mp4", tmp_path]
+        subprocess.run(command, check=True)
+        os.replace(tmp_path, output_path)
+
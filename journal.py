@@ -0,0 +1,76 @@
+import sqlite3
+import threading
+import time
+
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+) WITHOUT ROWID;
+'''
+
+
+class JobJournal:
+    '''
+    State of every download job (pending, running, done or failed), kept in SQLite.
+
+    Jobs are identified by a kind ('xml', 'm3u8', 'mp4') and a key (the output path relative
+    to the output directory). Every state change is its own small transaction, so after a crash
+    the journal says exactly which jobs finished and which were still queued or in flight.
+    Like the WorkQueue, it uses WAL mode unless wal=False, for an output directory that
+    download workers on several machines share.
+    '''
+    def __init__(self, journal_path, wal=True):
+        self.connection = sqlite3.connect(journal_path, timeout=60, check_same_thread=False)
+        self.connection.execute(f'PRAGMA journal_mode={"WAL" if wal else "DELETE"}')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def states(self, kind):
+        '''Return a dict of key -> state for every job of kind.'''
+        with self.lock:
+            return dict(self.connection.execute('SELECT key, state FROM jobs WHERE kind = ?', (kind,)))
+
+    def queue(self, kind, keys):
+        '''(Re)queue keys as pending.'''
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                '''INSERT INTO jobs (kind, key, state, updated) VALUES (?, ?, ?, ?)
+                   ON CONFLICT (kind, key) DO UPDATE SET state = excluded.state, updated = excluded.updated''',
+                ((kind, key, PENDING, now) for key in keys)
+            )
+
+    def set_state(self, kind, key, state, error=None):
+        with self.lock, self.connection:
+            self.connection.execute(
+                '''INSERT INTO jobs (kind, key, state, attempts, error, updated) VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (kind, key) DO UPDATE SET state = excluded.state, error = excluded.error,
+                   attempts = attempts + excluded.attempts, updated = excluded.updated''',
+                (kind, key, state, int(state == RUNNING), error, time.time())
+            )
+
+    def start(self, kind, key):
+        self.set_state(kind, key, RUNNING)
+
+    def finish(self, kind, key):
+        self.set_state(kind, key, DONE)
+
+    def fail(self, kind, key, error):
+        self.set_state(kind, key, FAILED, str(error))
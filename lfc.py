@@ -0,0 +1,239 @@
+import argparse
+import fnmatch
+import logging
+import os
+
+
+# Every command imports what it needs when it runs, so e.g. convert never loads requests, bs4 or the hls / scraping code.
+
+DATA_DIRECTORY = 'data'
+
+
+def open_catalog(args):
+    '''
+    The CatalogStore at --catalog, first updated from data/series.json and data/urls.json
+    if they changed since they were last imported or exported (a new catalog is filled from them).
+    A dry run gets an in-memory copy, so it doesn't create or write anything.
+    '''
+    from catalog import CatalogStore
+
+    catalog = CatalogStore.snapshot(args.catalog) if args.dry_run else CatalogStore(args.catalog)
+    imported = catalog.sync_json(os.path.join(DATA_DIRECTORY, 'urls.json'), os.path.join(DATA_DIRECTORY, 'series.json'))
+    if imported:
+        logging.info("Imported %s into %s", ', '.join(imported), args.catalog)
+    return catalog
+
+
+def selected_series(args, catalog):
+    '''The catalog's series.json entries that match --series.'''
+    return [
+        entry for entry in catalog.series()
+        if args.series is None or any(fnmatch.fnmatchcase(entry['title'], pattern) for pattern in args.series)
+    ]
+
+
+def make_downloader(args):
+    from hls import RenditionPreference
+    from scheduler import Scheduler
+    from utils import Downloader
+
+    rendition = RenditionPreference(getattr(args, 'max_height', None), getattr(args, 'max_bandwidth', None),
+                                    getattr(args, 'audio_only', False))
+    return Downloader(open_catalog(args), args.output, series=args.series, episodes=args.episodes, rendition=rendition,
+                      scheduler=Scheduler(host_rate=args.host_rate))
+
+
+def print_download_plan(downloader, kinds):
+    task_lists = {
+        'xml': downloader.xml_tasks,
+        'm3u8': downloader.stream_tasks,
+        'mp4': lambda: downloader.stream_tasks(downloader.rendition.extension),
+    }
+    for kind in kinds:
+        tasks = task_lists[kind]()
+        present = sum(os.path.exists(path) for _, path in tasks)
+        print(f"{kind}: {len(tasks)} files in {len(downloader.content_dictionary)} series, "
+              f"{len(tasks) - present} to download, {present} on disk (revalidated)")
+
+
+def scrape(args):
+    from utils import SeriesScraper, URLScraper
+
+    catalog = open_catalog(args)
+    if args.dry_run:
+        for entry in selected_series(args, catalog):
+            print(f"would scrape {entry['title']}")
+        return
+
+    SeriesScraper(catalog).scrape_series()
+    series = selected_series(args, catalog)
+    URLScraper.setup_all(series, catalog, max_workers=args.jobs or 8)
+    for entry in series:
+        URLScraper(entry['title'], entry['id'], catalog).write_xml_urls()
+    print(f"Scraped {len(series)} series into {args.catalog}")
+
+
+def resolve(args):
+    from utils import URLScraper
+
+    catalog = open_catalog(args)
+    scraper = None
+    for entry in selected_series(args, catalog):
+        # one transport for every series, so the scraper only logs in once
+        if scraper is None:
+            scraper = URLScraper(entry['title'], entry['id'], catalog)
+        else:
+            scraper = scraper.for_series(entry['title'], entry['id'])
+        if args.dry_run:
+            missing = sum(ep.get('stream_url') is None for ep in scraper.episodes)
+            print(f"{entry['title']}: {missing} of {len(scraper.episodes)} episodes without a stream url")
+            continue
+        scraper.write_stream_urls(refresh=args.refresh, max_workers=args.jobs or 8)
+
+
+def download(args):
+    args.kinds = args.kinds or ['xml']
+    downloader = make_downloader(args)
+    if args.dry_run:
+        print_download_plan(downloader, args.kinds)
+        return
+
+    if 'xml' in args.kinds:
+        downloader.download_xml_subtitles(args.jobs, refresh=args.refresh)
+    if 'm3u8' in args.kinds:
+        downloader.download_stream_files(args.jobs, refresh=args.refresh)
+    if 'mp4' in args.kinds:
+        downloader.download_mp4s(args.jobs or 4, refresh=args.refresh)
+
+
+def convert(args):
+    from converter import Converter
+
+    converter = Converter(args.output, series=args.series)
+    if args.dry_run:
+        print(f"{len(converter.pending(args.force))} XML files to convert")
+        return
+    converter.convert(args.jobs, force=args.force)
+
+
+def pipeline(args):
+    from converter import Converter
+
+    downloader = make_downloader(args)
+    if args.dry_run:
+        print_download_plan(downloader, ['xml'])
+        print("each XML file is converted as soon as it's downloaded")
+        return
+
+    converter = Converter(args.output, series=args.series)
+    processes = min(args.jobs or os.cpu_count() or 1, os.cpu_count() or 1)
+    converted = converter.convert_as_available(
+        downloader.iter_xml_subtitles(args.jobs, refresh=args.refresh), max_workers=processes, force=args.force
+    )
+    print(f"Converted {converted} files")
+
+
+def clips(args):
+    from clips import ClipExtractor
+
+    extractor = ClipExtractor(args.output, args.media, video=args.video)
+    if args.dry_run:
+        print(f"{len(extractor.find_episodes())} episodes with an SRT and media")
+        return
+    print(f"Extracted the clips of {extractor.extract(args.jobs, force=args.force)} episodes")
+
+
+def annotate(args):
+    from annotate import Annotator
+
+    annotator = Annotator(args.output)
+    if args.dry_run:
+        print(f"{len(annotator.scan_srt_files())} SRT files, unchanged ones are skipped")
+        return
+    print(f"Annotated {annotator.annotate(args.jobs, force=args.force)} new sentences")
+
+
+def export(args):
+    catalog = open_catalog(args)
+    outputs = [path for path in (args.urls_json, args.series_json, args.corpus) if path]
+    if args.dry_run:
+        for path in outputs:
+            print(f"would write {path}")
+        return
+
+    catalog.export_json(urls_json=args.urls_json, series_json=args.series_json)
+    if args.corpus:
+        from corpus import build_corpus
+
+        build_corpus(args.output, args.corpus, annotated=args.annotated)
+    for path in outputs:
+        print(f"Wrote {path}")
+
+
+if __name__ == "__main__":
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--catalog', default=os.path.join(DATA_DIRECTORY, 'catalog.sqlite3'),
+                        help="catalog database, created from data/*.json and updated from them whenever they change")
+    common.add_argument('--output', default='subtitles', help="output directory")
+    common.add_argument('--jobs', '-j', type=int, help="threads / processes to use (default: each command's own)")
+    common.add_argument('--series', nargs='+', help="series names or glob patterns")
+    common.add_argument('--episodes', help="episode spec for download / pipeline, e.g. '1-10,15,*dragon*'")
+    common.add_argument('--dry-run', '-n', action='store_true', help="only print what would be done")
+    common.add_argument('--metrics', help="write the run's metrics to this file (.json or .prom)")
+    common.add_argument('--verbose', '-v', action='store_true')
+
+    parser = argparse.ArgumentParser(description="Scrape, download and convert the Little Fox Chinese catalog")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('scrape', parents=[common], help="scrape the series and their episodes into the catalog")
+
+    resolve_parser = subparsers.add_parser('resolve', parents=[common], help="resolve the episodes' stream urls")
+    resolve_parser.add_argument('--refresh', action='store_true', help="also episodes that already have one")
+
+    download_parser = subparsers.add_parser('download', parents=[common], help="download xml subtitles, playlists or mp4s")
+    download_parser.add_argument('kinds', nargs='*', metavar='{xml,m3u8,mp4}', help="what to download (default: xml)")
+    download_parser.add_argument('--refresh', action='store_true', help="redo jobs the journal has as done")
+    download_parser.add_argument('--max-height', type=int, help="best rendition of at most this many lines")
+    download_parser.add_argument('--max-bandwidth', type=int, help="best rendition of at most this many bits per second")
+    download_parser.add_argument('--audio-only', action='store_true', help="keep only the audio, as .m4a")
+    download_parser.add_argument('--host-rate', type=float, help="at most this many requests per second per host")
+
+    convert_parser = subparsers.add_parser('convert', parents=[common], help="convert the XML subtitles to SRT and TXT")
+    convert_parser.add_argument('--force', action='store_true', help="also files that didn't change")
+
+    pipeline_parser = subparsers.add_parser('pipeline', parents=[common],
+                                            help="download the XML subtitles and convert each one as soon as it arrives")
+    pipeline_parser.add_argument('--refresh', action='store_true', help="redo downloads the journal has as done")
+    pipeline_parser.add_argument('--force', action='store_true', help="also convert files that didn't change")
+    pipeline_parser.add_argument('--host-rate', type=float, help="at most this many requests per second per host")
+
+    clips_parser = subparsers.add_parser('clips', parents=[common], help="cut every cue out of the episodes' media")
+    clips_parser.add_argument('--media', help="directory of the downloaded media (default: --output)")
+    clips_parser.add_argument('--video', action='store_true', help="video clips instead of audio only")
+    clips_parser.add_argument('--force', action='store_true', help="also episodes that didn't change")
+
+    annotate_parser = subparsers.add_parser('annotate', parents=[common], help="add word segmentation and pinyin to the SRTs")
+    annotate_parser.add_argument('--force', action='store_true', help="also files that didn't change")
+
+    export_parser = subparsers.add_parser('export', parents=[common], help="write the catalog as json and / or the corpus file")
+    export_parser.add_argument('--urls-json', help="e.g. data/urls.json")
+    export_parser.add_argument('--series-json', help="e.g. data/series.json")
+    export_parser.add_argument('--corpus', help="pack the converted SRTs into this corpus file")
+    export_parser.add_argument('--annotated', action='store_true', help="use the annotated SRTs in the corpus")
+
+    args = parser.parse_args()
+    if args.command == 'download' and not set(args.kinds) <= {'xml', 'm3u8', 'mp4'}:
+        download_parser.error(f"can't download {', '.join(sorted(set(args.kinds) - {'xml', 'm3u8', 'mp4'}))}")
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(levelname)s %(name)s: %(message)s')
+
+    commands = {
+        'scrape': scrape, 'resolve': resolve, 'download': download, 'convert': convert, 'pipeline': pipeline,
+        'clips': clips, 'annotate': annotate, 'export': export,
+    }
+    commands[args.command](args)
+
+    if args.metrics:
+        from metrics import registry
+
+        registry.write(args.metrics)
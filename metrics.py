@@ -0,0 +1,180 @@
+import bisect
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from fileio import open_atomic
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        '''Upper bound of the bucket holding the q-th quantile (inf if it's past the last bucket).'''
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    '''
+    Thread-safe registry of counters, gauges and latency histograms.
+
+    Metrics are keyed by name plus an optional dict of labels (e.g. {'stage': 'parse'})
+    and can be written out as json or in the Prometheus text format.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())) if labels else ())
+
+    def inc(self, name, value=1, labels=None):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, labels=None):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, stage):
+        '''Record the duration of the block in the stage_seconds histogram.'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, {'stage': stage})
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def to_dict(self):
+        def label_string(labels):
+            return ','.join(f'{k}={v}' for k, v in labels)
+
+        with self.lock:
+            return {
+                'counters': {f'{name}{{{label_string(labels)}}}': value for (name, labels), value in self.counters.items()},
+                'gauges': {f'{name}{{{label_string(labels)}}}': value for (name, labels), value in self.gauges.items()},
+                'histograms': {
+                    f'{name}{{{label_string(labels)}}}': {
+                        'count': h.count,
+                        'sum': h.sum,
+                        'p50': h.quantile(0.5),
+                        'p99': h.quantile(0.99),
+                        'buckets': dict(zip([str(b) for b in h.buckets] + ['+Inf'], h.counts)),
+                    }
+                    for (name, labels), h in self.histograms.items()
+                },
+            }
+
+    def to_prometheus(self):
+        def label_string(labels, extra=()):
+            labels = tuple(labels) + tuple(extra)
+            return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}' if labels else ''
+
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f'lfc_{name}{label_string(labels)} {value}')
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f'lfc_{name}{label_string(labels)} {value}')
+            for (name, labels), h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip([str(b) for b in h.buckets] + ['+Inf'], h.counts):
+                    cumulative += count
+                    lines.append(f'lfc_{name}_bucket{label_string(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'lfc_{name}_sum{label_string(labels)} {h.sum}')
+                lines.append(f'lfc_{name}_count{label_string(labels)} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        '''Write the metrics to path, in the Prometheus text format if it ends in .prom, else as json.'''
+        with open_atomic(path) as f:
+            if path.endswith('.prom'):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=4)
+
+
+# the registry the transport, scheduler, Downloader and Converter record into
+registry = Metrics()
+
+
+class Progress:
+    '''
+    Compact live progress line on stderr ("label  done/total  rate/s  failed"),
+    redrawn at most every interval seconds and only when stderr is a terminal.
+    '''
+    def __init__(self, total, label, interval=0.2, stream=sys.stderr):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.stream = stream
+        self.enabled = stream.isatty()
+        self.done = 0
+        self.failed = 0
+        self.start = time.monotonic()
+        self.drawn = 0.0
+        self.lock = threading.Lock()
+
+    def update(self, count=1, failed=False):
+        with self.lock:
+            self.done += count
+            if failed:
+                self.failed += count
+            now = time.monotonic()
+            if self.enabled and (now - self.drawn >= self.interval or self.done >= self.total):
+                self.drawn = now
+                self.draw(now)
+
+    def draw(self, now):
+        rate = self.done / max(now - self.start, 1e-9)
+        line = f'{self.label}  {self.done}/{self.total}  {rate:.1f}/s'
+        if self.failed:
+            line += f'  {self.failed} failed'
+        self.stream.write('\r' + line.ljust(60))
+        self.stream.flush()
+
+    def close(self):
+        if self.enabled:
+            self.draw(time.monotonic())
+            self.stream.write('\n')
+            self.stream.flush()
@@ -0,0 +1,158 @@
+import concurrent.futures
+import itertools
+import queue
+import threading
+import time
+from urllib.parse import urlsplit
+
+from metrics import registry
+
+
+# priority classes, lower runs first
+CAPTIONS = 0
+PLAYLISTS = 1
+VIDEO = 2
+
+THROTTLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    '''
+    Classic token bucket: refills at rate tokens per second up to capacity.
+    take() may drive the balance negative (used for byte counts only known after a download),
+    in which case the next caller waits until it is paid back.
+    '''
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, tokens=1):
+        '''Block until tokens are available, then take them.'''
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= min(tokens, self.capacity):
+                    self.tokens -= tokens
+                    return
+                delay = (min(tokens, self.capacity) - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def take(self, tokens):
+        '''Take tokens without waiting, then sleep off any debt.'''
+        with self.lock:
+            self.refill()
+            self.tokens -= tokens
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class Scheduler:
+    '''
+    One job queue shared by every Downloader task.
+
+    Jobs run on a fixed set of worker threads in priority order (captions before playlists before video).
+    The number of jobs allowed to run at once adapts: it is halved whenever a request is answered
+    with 429/5xx and grows back by one after a window of successful requests.
+    The HTTPTransport calls before_request / after_response around every request,
+    which applies the per-host request rate and the global bandwidth cap. Neither is limited
+    by default: host_rate (requests per second per host) and bandwidth_limit (bytes per second) opt in.
+    '''
+    def __init__(self, max_workers=20, host_rate=None, bandwidth_limit=None):
+        self.max_workers = max_workers
+        self.host_rate = host_rate
+        self.bandwidth = TokenBucket(bandwidth_limit) if bandwidth_limit else None
+
+        self.jobs = queue.PriorityQueue()
+        self.order = itertools.count()
+        self.host_buckets = {}
+
+        self.condition = threading.Condition()
+        self.limit = max_workers
+        self.running = 0
+        self.successes = 0
+
+        self.workers = []
+        self.add_workers(max_workers)
+
+    def add_workers(self, count):
+        for _ in range(count):
+            worker = threading.Thread(target=self.work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def set_max_workers(self, max_workers):
+        '''Change the concurrency ceiling, starting more worker threads if needed.'''
+        with self.condition:
+            self.max_workers = max_workers
+            self.limit = min(self.limit, max_workers)
+            self.condition.notify_all()
+        if max_workers > len(self.workers):
+            self.add_workers(max_workers - len(self.workers))
+
+    def submit(self, priority, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        with self.condition:
+            self.jobs.put((priority, next(self.order), future, fn, args, kwargs))
+            registry.set('scheduler_queue_depth', self.jobs.qsize())
+            self.condition.notify()
+        return future
+
+    def work(self):
+        while True:
+            # wait for a free slot before taking a job, so the job that runs is the most urgent one
+            # queued when the slot frees up, not one taken out of the queue before it was submitted
+            with self.condition:
+                while self.running >= self.limit or self.jobs.empty():
+                    self.condition.wait()
+                _, _, future, fn, args, kwargs = self.jobs.get_nowait()
+                self.running += 1
+                registry.set('scheduler_queue_depth', self.jobs.qsize())
+                registry.set('scheduler_running', self.running)
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+
+            with self.condition:
+                self.running -= 1
+                registry.set('scheduler_running', self.running)
+                self.condition.notify()
+
+    def host_bucket(self, url):
+        host = urlsplit(url).netloc
+        with self.condition:
+            if host not in self.host_buckets:
+                self.host_buckets[host] = TokenBucket(self.host_rate)
+            return self.host_buckets[host]
+
+    def before_request(self, url):
+        if self.host_rate:
+            self.host_bucket(url).wait()
+
+    def after_response(self, status_code=None, size=0):
+        '''Feed back the outcome of a request: status None means the connection failed.'''
+        if self.bandwidth and size:
+            self.bandwidth.take(size)
+
+        with self.condition:
+            if status_code is None or status_code in THROTTLE_STATUSES:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_workers:
+                    self.limit += 1
+                    self.successes = 0
+                    self.condition.notify()
+            registry.set('scheduler_concurrency_limit', self.limit)
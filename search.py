@@ -0,0 +1,180 @@
+import os
+import re
+import sqlite3
+from datetime import timedelta
+
+import srt
+
+
+HANZI_RUN = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS episodes (
+    id INTEGER PRIMARY KEY,
+    series TEXT NOT NULL,
+    episode TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    UNIQUE (series, episode)
+);
+CREATE TABLE IF NOT EXISTS cues (
+    id INTEGER PRIMARY KEY,
+    episode_id INTEGER NOT NULL REFERENCES episodes(id),
+    cue INTEGER NOT NULL,
+    start_ms INTEGER NOT NULL,
+    end_ms INTEGER NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cues_episode ON cues(episode_id);
+CREATE TABLE IF NOT EXISTS postings (
+    gram TEXT NOT NULL,
+    cue_id INTEGER NOT NULL,
+    PRIMARY KEY (gram, cue_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_cue ON postings(cue_id);
+'''
+
+
+def ngrams(text):
+    '''
+    Character bigrams and trigrams of every run of hanzi in text.
+    '''
+    grams = set()
+    for run in HANZI_RUN.findall(text):
+        for n in (2, 3):
+            grams.update(run[i:i + n] for i in range(len(run) - n + 1))
+    return grams
+
+
+def query_grams(query):
+    '''The smallest set of index grams every cue containing query must have.'''
+    grams = set()
+    for run in HANZI_RUN.findall(query):
+        n = min(3, len(run))
+        if n == 1:
+            continue
+        grams.update(run[i:i + n] for i in range(len(run) - n + 1))
+    return grams
+
+
+class SubtitleIndex:
+    '''
+    Inverted index of hanzi bigrams/trigrams over the converted .srt files, stored in SQLite.
+
+    Postings point at cues, which keep their series, episode, cue number and start/end milliseconds,
+    so a search answers "where is this phrase said, and when" without touching the subtitle files.
+    update() only re-indexes episodes whose .srt changed since the last run.
+    '''
+    def __init__(self, index_path):
+        self.connection = sqlite3.connect(index_path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def scan_srt_files(self, subtitle_directory):
+        '''Return a dict of (series, episode) -> (srt path, os.stat_result).'''
+        srt_files = {}
+        for series_entry in os.scandir(subtitle_directory):
+            if not series_entry.is_dir():
+                continue
+            for ep_entry in os.scandir(series_entry.path):
+                srt_path = os.path.join(ep_entry.path, f'{ep_entry.name}.srt')
+                if ep_entry.is_dir() and os.path.exists(srt_path):
+                    srt_files[(series_entry.name, ep_entry.name)] = (srt_path, os.stat(srt_path))
+        return srt_files
+
+    def update(self, subtitle_directory):
+        '''Index new and changed episodes and drop the ones whose .srt is gone.
+
+        :return: (number of episodes indexed, number removed)
+        '''
+        srt_files = self.scan_srt_files(subtitle_directory)
+        known = {
+            (series, episode): (episode_id, mtime_ns, size)
+            for episode_id, series, episode, mtime_ns, size
+            in self.connection.execute('SELECT id, series, episode, mtime_ns, size FROM episodes')
+        }
+
+        indexed = 0
+        with self.connection:
+            for key, (srt_path, stat) in srt_files.items():
+                if key in known and known[key][1:] == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                if key in known:
+                    self.remove_episode(known[key][0])
+                self.add_episode(key[0], key[1], srt_path, stat)
+                indexed += 1
+
+            removed = [known[key][0] for key in known if key not in srt_files]
+            for episode_id in removed:
+                self.remove_episode(episode_id)
+
+        return indexed, len(removed)
+
+    def add_episode(self, series, episode, srt_path, stat):
+        with open(srt_path, 'r', encoding='utf-8') as f:
+            subtitles = list(srt.parse(f.read()))
+
+        cursor = self.connection.execute(
+            'INSERT INTO episodes (series, episode, mtime_ns, size) VALUES (?, ?, ?, ?)',
+            (series, episode, stat.st_mtime_ns, stat.st_size)
+        )
+        episode_id = cursor.lastrowid
+        for subtitle in subtitles:
+            cursor = self.connection.execute(
+                'INSERT INTO cues (episode_id, cue, start_ms, end_ms, text) VALUES (?, ?, ?, ?, ?)',
+                (episode_id, subtitle.index, subtitle.start // timedelta(milliseconds=1),
+                 subtitle.end // timedelta(milliseconds=1), subtitle.content)
+            )
+            cue_id = cursor.lastrowid
+            self.connection.executemany(
+                'INSERT INTO postings (gram, cue_id) VALUES (?, ?)',
+                ((gram, cue_id) for gram in ngrams(subtitle.content))
+            )
+
+    def remove_episode(self, episode_id):
+        self.connection.execute(
+            'DELETE FROM postings WHERE cue_id IN (SELECT id FROM cues WHERE episode_id = ?)', (episode_id,)
+        )
+        self.connection.execute('DELETE FROM cues WHERE episode_id = ?', (episode_id,))
+        self.connection.execute('DELETE FROM episodes WHERE id = ?', (episode_id,))
+
+    def search(self, query, limit=50):
+        '''
+        Find the cues containing query.
+
+        Hits are ranked by how often the phrase occurs in the cue, then by how short the cue is
+        (a short cue is a cleaner example sentence).
+
+        :return: A list of dicts with series, episode, cue, start_ms, end_ms and text.
+        '''
+        query = query.strip()
+        if not query:
+            return []
+
+        grams = query_grams(query)
+        columns = 'e.series, e.episode, c.cue, c.start_ms, c.end_ms, c.text'
+        if grams:
+            placeholders = ', '.join('?' * len(grams))
+            rows = self.connection.execute(
+                f'''SELECT {columns} FROM cues c JOIN episodes e ON e.id = c.episode_id
+                    WHERE c.id IN (
+                        SELECT cue_id FROM postings WHERE gram IN ({placeholders})
+                        GROUP BY cue_id HAVING COUNT(*) = ?
+                    ) AND instr(c.text, ?) > 0''',
+                (*grams, len(grams), query)
+            )
+        else:
+            # nothing to look up (a single hanzi, pinyin...), fall back to scanning the cue texts
+            rows = self.connection.execute(
+                f'SELECT {columns} FROM cues c JOIN episodes e ON e.id = c.episode_id WHERE instr(c.text, ?) > 0',
+                (query,)
+            )
+
+        hits = [
+            {'series': series, 'episode': episode, 'cue': cue, 'start_ms': start_ms, 'end_ms': end_ms, 'text': text}
+            for series, episode, cue, start_ms, end_ms, text in rows
+        ]
+        hits.sort(key=lambda hit: (-hit['text'].count(query), len(hit['text'])))
+        return hits[:limit]
@@ -0,0 +1,69 @@
+import os
+import sys
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class LocalSite:
+    '''
+    A stand-in for the site on 127.0.0.1: routes map a path to a function (handler, query) -> (status, body),
+    and every request is counted by path and query.
+    '''
+    def __init__(self):
+        self.routes = {}
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                site.handle(self)
+
+            def do_POST(self):
+                site.handle(self)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def handle(self, handler):
+        path, _, query = handler.path.partition('?')
+        with self.lock:
+            self.requests[(handler.command, path, query)] += 1
+        route = self.routes.get((handler.command, path))
+        status, body, headers = route(handler, query) if route else (404, 'not found', {})
+        body = body.encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'text/html; charset=utf-8')
+        handler.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def site():
+    local_site = LocalSite()
+    yield local_site
+    local_site.close()
+
+
+def read_fixture(*path):
+    with open(os.path.join(FIXTURES, *path), 'r', encoding='utf-8') as f:
+        return f.read()
@@ -0,0 +1,148 @@
+import threading
+import time
+from urllib.parse import parse_qs
+
+import pytest
+
+from catalog import CatalogStore
+from transport import HTTPTransport
+from utils import URLScraper, parse_stream_url
+
+
+SERIES = 'dragon-eggs'
+EPISODES = [{'title': f'Dragon Eggs {i}', 'id': f'C000{60100 + i}'} for i in range(1, 11)]
+LOGIN_FORM = '''<html><body>
+<form class="login_form" method="post" action="/en/member/login_proc">
+    <input type="hidden" name="token" value="f00d">
+    <input type="text" name="loginid">
+    <input type="password" name="loginpw">
+    <button class="btn_login">Log in</button>
+</form>
+</body></html>'''
+ACCOUNT_MENU = '<html><body><a class="btn_logout" href="/en/member/logout">Log out</a></body></html>'
+
+
+def player_payload(ep_id, height=1080):
+    return '{"fc_id":"%s","video_url":"\\/contents_5\\/cn\\/hls\\/%d\\/%s\\/stream.m3u8?_=1700000000"}' % (
+        ep_id, height, ep_id
+    )
+
+
+def test_parse_stream_url_1080():
+    assert parse_stream_url(f'var player = {player_payload("C00060101")};') == \
+        'https://cdn.littlefox.co.kr//contents_5/cn/hls/1080/C00060101/stream.m3u8?_=1700000000'
+
+
+@pytest.mark.parametrize('height', [360, 720])
+def test_parse_stream_url_other_heights(height):
+    assert parse_stream_url(player_payload('C00060101', height)).endswith(
+        f'/contents_5/cn/hls/{height}/C00060101/stream.m3u8?_=1700000000'
+    )
+
+
+@pytest.mark.parametrize('page_source', [
+    '',
+    LOGIN_FORM,
+    '{"video_url":""}',
+    '{"video_url":"\\/contents_5\\/cn\\/mp4\\/C00060101.mp4"}',
+])
+def test_parse_stream_url_no_match(page_source):
+    assert parse_stream_url(page_source) is None
+
+
+class PlayerSite:
+    '''Routes for the homepage login form, its POST action and the player, which only answers signed in sessions.'''
+    def __init__(self, site, username='kip', password='scales'):
+        self.username = username
+        self.password = password
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.lock = threading.Lock()
+        site.routes[('GET', '/en')] = self.homepage
+        site.routes[('POST', '/en/member/login_proc')] = self.login
+        site.routes[('GET', URLScraper.player_path)] = self.player
+
+    @staticmethod
+    def signed_in(handler):
+        return 'session=signed-in' in (handler.headers.get('Cookie') or '')
+
+    def homepage(self, handler, query):
+        return 200, ACCOUNT_MENU if self.signed_in(handler) else LOGIN_FORM, {}
+
+    def login(self, handler, query):
+        form = parse_qs(handler.rfile.read(int(handler.headers['Content-Length'])).decode('utf-8'))
+        if form.get('token') != ['f00d'] or form.get('loginid') != [self.username] or form.get('loginpw') != [self.password]:
+            return 200, LOGIN_FORM, {}
+        return 200, ACCOUNT_MENU, {'Set-Cookie': 'session=signed-in; Path=/'}
+
+    def player(self, handler, query):
+        if not self.signed_in(handler):
+            return 200, '<html>please log in</html>', {}
+        with self.lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        # long enough for the resolver's other requests to overlap this one
+        time.sleep(0.05)
+        with self.lock:
+            self.in_flight -= 1
+        return 200, f'<script>var player = {player_payload(parse_qs(query)["fc_id"][0])};</script>', {}
+
+
+def make_scraper(site, tmp_path):
+    catalog = CatalogStore(str(tmp_path / 'catalog.sqlite3'))
+    catalog.set_episodes(SERIES, EPISODES)
+    scraper = URLScraper(SERIES, 'C0006', catalog, transport=HTTPTransport(retries=0))
+    scraper.site_url = site.url
+    return scraper
+
+
+def test_login_then_resolve_concurrently(site, tmp_path, monkeypatch):
+    monkeypatch.setenv('LFC_USERNAME', 'kip')
+    monkeypatch.setenv('LFC_PASSWORD', 'scales')
+    player_site = PlayerSite(site)
+    scraper = make_scraper(site, tmp_path)
+
+    stream_urls = scraper.resolve_stream_urls(max_workers=8, selenium_fallback=False)
+
+    assert stream_urls == [
+        f'https://cdn.littlefox.co.kr//contents_5/cn/hls/1080/{ep["id"]}/stream.m3u8?_=1700000000' for ep in EPISODES
+    ]
+    assert site.requests[('POST', '/en/member/login_proc', '')] == 1
+    assert sum(count for (method, path, _), count in site.requests.items() if path == URLScraper.player_path) == 10
+    assert player_site.peak_in_flight > 1
+
+
+def test_login_with_wrong_password_is_an_error(site, tmp_path, monkeypatch):
+    monkeypatch.setenv('LFC_USERNAME', 'kip')
+    monkeypatch.setenv('LFC_PASSWORD', 'wrong')
+    PlayerSite(site)
+    scraper = make_scraper(site, tmp_path)
+
+    with pytest.raises(RuntimeError, match='Login as kip failed'):
+        scraper.resolve_stream_urls(selenium_fallback=False)
+    assert not any(path == URLScraper.player_path for _, path, _ in site.requests)
+
+
+@pytest.mark.parametrize('missing', ['LFC_USERNAME', 'LFC_PASSWORD'])
+def test_login_without_credentials_is_an_error(site, tmp_path, monkeypatch, missing):
+    monkeypatch.setenv('LFC_USERNAME', 'kip')
+    monkeypatch.setenv('LFC_PASSWORD', 'scales')
+    monkeypatch.delenv(missing)
+    PlayerSite(site)
+    scraper = make_scraper(site, tmp_path)
+
+    with pytest.raises(RuntimeError, match='LFC_USERNAME and LFC_PASSWORD'):
+        scraper.login()
+    assert not site.requests
+
+
+def test_one_login_for_several_series(site, tmp_path, monkeypatch):
+    monkeypatch.setenv('LFC_USERNAME', 'kip')
+    monkeypatch.setenv('LFC_PASSWORD', 'scales')
+    PlayerSite(site)
+    scraper = make_scraper(site, tmp_path)
+    scraper.catalog.set_episodes('dragon-eggs-2', EPISODES[:3])
+
+    assert all(scraper.resolve_stream_urls(selenium_fallback=False))
+    assert all(scraper.for_series('dragon-eggs-2', 'C0007').resolve_stream_urls(selenium_fallback=False))
+    assert site.requests[('POST', '/en/member/login_proc', '')] == 1
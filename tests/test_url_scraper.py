@@ -0,0 +1,64 @@
+import pytest
+
+from catalog import CatalogStore
+from conftest import read_fixture
+from transport import HTTPTransport
+from utils import URLScraper
+
+
+SERIES_ID = 'C0006'
+LISTING_PATH = f'/en/story/contents_list/{SERIES_ID}'
+
+
+def serve_listing(site, failing_pages=()):
+    '''Serve the saved listing pages of a 10 episode series at the series' contents_list url.'''
+    def listing(handler, query):
+        page = int(query.rsplit('page=', 1)[1])
+        if page in failing_pages:
+            return 503, 'unavailable', {}
+        return 200, read_fixture('contents_list', f'page{page}.html'), {}
+
+    site.routes[('GET', LISTING_PATH)] = listing
+
+
+def make_scraper(site, catalog):
+    scraper = URLScraper('dragon-eggs', SERIES_ID, catalog, transport=HTTPTransport(retries=1, backoff_base=0.01))
+    scraper.main_url = f'{site.url}{LISTING_PATH}'
+    return scraper
+
+
+def test_every_listing_page_is_fetched_once(site, tmp_path):
+    serve_listing(site)
+    scraper = make_scraper(site, str(tmp_path / 'catalog.sqlite3'))
+
+    scraper.get_episodes()
+
+    assert scraper.page_count == 3
+    assert site.requests == {('GET', LISTING_PATH, f'&page={page}'): 1 for page in (1, 2, 3)}
+
+
+def test_titles_are_paired_with_their_ids(site, tmp_path):
+    serve_listing(site)
+    scraper = make_scraper(site, str(tmp_path / 'catalog.sqlite3'))
+
+    episodes = scraper.get_episodes()
+
+    assert [episode['id'] for episode in episodes] == [f'C000{60101 + i}' for i in range(10)]
+    assert episodes[5] == {'title': 'The Lost Scale', 'id': 'C00060106'}
+    assert episodes[7] == {'title': "Kip's Birthday", 'id': 'C00060108'}
+    assert episodes[-1] == {'title': 'The End', 'id': 'C00060110'}
+
+
+@pytest.mark.parametrize('failing_page', [1, 2])
+def test_a_failed_page_leaves_the_catalog_alone(site, tmp_path, failing_page):
+    serve_listing(site)
+    catalog = CatalogStore(str(tmp_path / 'catalog.sqlite3'))
+    make_scraper(site, catalog).setup_json()
+    catalog.set_urls('dragon-eggs', 'stream_url', {'C00060110': 'https://cdn.example/stream.m3u8'})
+    before = catalog.episodes('dragon-eggs')
+
+    serve_listing(site, failing_pages=(failing_page,))
+    with pytest.raises(RuntimeError):
+        make_scraper(site, catalog).setup_json()
+
+    assert catalog.episodes('dragon-eggs') == before
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from email.utils import formatdate
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from fileio import write_atomic
+from metrics import registry
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class HTTPTransport:
+    '''
+    Shared HTTP transport used by the Downloader for every fetch.
+    Keeps one pooled requests.Session (so keep-alive connections to the cdn are reused),
+    caps the number of in-flight requests per host and retries failed requests
+    with jittered exponential backoff.
+    If a scheduler is set, every request also waits for its per-host rate limit
+    and reports its outcome back so the scheduler can adapt its concurrency.
+    '''
+    def __init__(self, pool_size=20, per_host_limit=20, retries=4, backoff_base=0.5, backoff_max=30, timeout=30, scheduler=None):
+        self.scheduler = scheduler
+        self.per_host_limit = per_host_limit
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._host_slots = {}
+        self._host_slots_lock = threading.Lock()
+
+    def host_slot(self, url):
+        '''Return the semaphore limiting concurrent requests to the host of url.'''
+        host = urlsplit(url).netloc
+        with self._host_slots_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self._host_slots[host]
+
+    def backoff(self, attempt, retry_after=None):
+        '''
+        Seconds to wait before the given retry attempt (0 based).
+        Uses "full jitter": a random delay between 0 and the capped exponential step,
+        which keeps many threads that failed together from retrying together.
+        A Retry-After header sent by the server takes precedence.
+        '''
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def request(self, method, url, **kwargs):
+        '''
+        Send a request, retrying connection errors and 429/5xx responses.
+
+        :return: The final requests.Response, after raise_for_status().
+        :raises requests.RequestException: When the request still fails after all retries.
+        '''
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlsplit(url).netloc
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            if attempt:
+                registry.inc('http_retries_total', labels={'host': host})
+            if self.scheduler:
+                self.scheduler.before_request(url)
+            start = time.perf_counter()
+            try:
+                with self.host_slot(url):
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+                registry.inc('http_responses_total', labels={'host': host, 'status': 'error'})
+                if self.scheduler:
+                    self.scheduler.after_response()
+                if last_attempt:
+                    raise
+                time.sleep(self.backoff(attempt))
+                continue
+            size = len(response.content)
+            registry.observe('http_request_seconds', time.perf_counter() - start, {'host': host})
+            registry.inc('http_responses_total', labels={'host': host, 'status': response.status_code})
+            registry.inc('http_bytes_total', size, {'host': host})
+            if self.scheduler:
+                self.scheduler.after_response(response.status_code, size)
+
+            if response.status_code in RETRY_STATUSES and not last_attempt:
+                retry_after = response.headers.get('Retry-After')
+                response.close()
+                time.sleep(self.backoff(attempt, retry_after))
+                continue
+
+            response.raise_for_status()
+            return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+class ConditionalCache:
+    '''
+    Remembers ETag, Last-Modified, size and sha256 of every url fetched into the output directory,
+    so later runs can send If-None-Match / If-Modified-Since and only rewrite files that changed.
+    The cache is a plain json file mapping url -> metadata.
+    '''
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.entries = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                self.entries = json.load(f)
+        self._lock = threading.Lock()
+
+    def conditional_headers(self, url, path):
+        '''
+        Validators to send when re-fetching url into path.
+        Files downloaded before the cache existed fall back to their mtime as If-Modified-Since.
+        '''
+        if not os.path.exists(path):
+            return {}
+
+        with self._lock:
+            entry = self.entries.get(url)
+
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        if not headers:
+            headers['If-Modified-Since'] = formatdate(os.path.getmtime(path), usegmt=True)
+        return headers
+
+    def is_unchanged(self, url, content):
+        '''True if content hashes the same as what was last stored for url.'''
+        with self._lock:
+            entry = self.entries.get(url)
+        return bool(entry) and entry.get('sha256') == hashlib.sha256(content).hexdigest()
+
+    def record(self, url, response, content=None, path=None):
+        '''
+        Store the validators of response for url.
+        The size and hash come from content, or from the file at path for 304 responses.
+        '''
+        with self._lock:
+            entry = dict(self.entries.get(url, {}))
+
+        if response.headers.get('ETag'):
+            entry['etag'] = response.headers['ETag']
+        if response.headers.get('Last-Modified'):
+            entry['last_modified'] = response.headers['Last-Modified']
+
+        if content is None and path is not None and 'sha256' not in entry:
+            with open(path, 'rb') as f:
+                content = f.read()
+        if content is not None:
+            entry['size'] = len(content)
+            entry['sha256'] = hashlib.sha256(content).hexdigest()
+
+        with self._lock:
+            self.entries[url] = entry
+
+    def save(self):
+        with self._lock:
+            entries = dict(self.entries)
+        write_atomic(self.cache_path, json.dumps(entries, indent=4))
@@ -1,29 +1,166 @@
 import json
-import glob
+import fnmatch
+import logging
 import requests
 from bs4 import BeautifulSoup
-from datetime import timedelta
-import srt
 import re
 import os
+import time
 import concurrent.futures
+import threading
+import subprocess
+from urllib.parse import urljoin
+from transport import HTTPTransport, ConditionalCache
+from hls import HLSDownloader, SegmentError, RenditionPreference, media_is_complete
+from scheduler import Scheduler, CAPTIONS, PLAYLISTS
+from metrics import registry, Progress
+from journal import JobJournal, PENDING, RUNNING, DONE
+from catalog import CatalogStore
+from workqueue import worker_name
+# the Converter lives in converter.py, so conversion doesn't import requests / bs4; still importable from here
+from converter import Converter, ConversionManifest  # noqa: F401
+from fileio import write_atomic
+
+
+logger = logging.getLogger(__name__)
 
 
 def normalize_title(title):
     return title.lower().strip().replace(' ', '-')
 
 
+def open_catalog(catalog):
+    '''Accept a CatalogStore or the path of its database.'''
+    return catalog if isinstance(catalog, CatalogStore) else CatalogStore(catalog)
+
+
+_catalogs = {}
+
+
+def build_content_dictionary(urls):
+    '''I think the only reason I'm doing this is because I didn't think ahead while building the urls json
+       and I don't want to build it again cuz I had to let it run overnight...
+
+    :return: {series: {'<number>_<title>': {'xml_url': ..., 'stream_url': ...}}}
+    '''
+    content_dic = {}
+    for elem in urls:
+        series_dic = {}
+        ep_cnt = 1
+        for info in urls[elem]:
+            ep_name = f'{ep_cnt}_{normalize_title(info['title'])}'
+            # urls that weren't scraped / resolved yet are None; the episode keeps its number regardless
+            series_dic[ep_name] = {
+                'xml_url': info.get('xml_url'),
+                'stream_url': info.get('stream_url')
+            }
+            ep_cnt += 1
+
+        content_dic[elem] = series_dic
+
+    return content_dic
+
+
+def load_catalog(urls_json):
+    '''
+    The content dictionary of urls_json.
+
+    Parsed catalogs are kept for the life of the process, keyed on the file's path, mtime and size,
+    so creating several Downloaders (or re-running one series) doesn't re-read the json.
+    urls_json may also be a CatalogStore or its database (.sqlite3), which are read fresh every time.
+    '''
+    if isinstance(urls_json, CatalogStore):
+        return build_content_dictionary(urls_json.urls())
+    if urls_json.endswith('.sqlite3'):
+        with CatalogStore(urls_json) as catalog:
+            return build_content_dictionary(catalog.urls())
+
+    stat = os.stat(urls_json)
+    key = (os.path.abspath(urls_json), stat.st_mtime_ns, stat.st_size)
+    if key not in _catalogs:
+        with open(urls_json, 'r') as f:
+            _catalogs[key] = build_content_dictionary(json.load(f))
+    return _catalogs[key]
+
+
+def parse_episode_spec(spec):
+    '''
+    Split an episode spec like '1-10,15,20-,*dragon*' into number ranges and name patterns.
+
+    :return: (list of (first, last) with last None for open ranges, list of glob patterns)
+    '''
+    ranges, patterns = [], []
+    parts = spec.split(',') if isinstance(spec, str) else spec
+    for part in (str(part).strip() for part in parts):
+        if not part:
+            continue
+        first, dash, last = part.partition('-')
+        if first.isdigit() and (not dash or not last or last.isdigit()):
+            ranges.append((int(first), int(last) if last else (None if dash else int(first))))
+        else:
+            patterns.append(part)
+    return ranges, patterns
+
+
+def select_content(content_dictionary, series=None, episodes=None):
+    '''
+    Filter a content dictionary down to the matching series and episodes.
+
+    :param series: Series names or glob patterns (None selects every series).
+    :param episodes: Episode spec, see parse_episode_spec (None selects every episode).
+    '''
+    if isinstance(series, str):
+        series = [series]
+    if series is not None:
+        content_dictionary = {
+            name: eps for name, eps in content_dictionary.items()
+            if any(fnmatch.fnmatchcase(name, pattern) for pattern in series)
+        }
+    if episodes is None:
+        return content_dictionary
+
+    ranges, patterns = parse_episode_spec(episodes)
+
+    def selected(ep_name):
+        number = int(ep_name.split('_', 1)[0])
+        return any(first <= number and (last is None or number <= last) for first, last in ranges) \
+            or any(fnmatch.fnmatchcase(ep_name, pattern) for pattern in patterns)
+
+    return {
+        name: {ep: info for ep, info in eps.items() if selected(ep)}
+        for name, eps in content_dictionary.items()
+    }
+
+
+# any rendition, the player currently serves /hls/1080/ (see RenditionPreference for picking another)
+STREAM_URL_PATTERN = re.compile(r'video_url":"(\\/contents_5\\/cn\\/hls\\/\d+\\/[^"]+\\/stream\.m3u8\?_[^"]+)"')
+
+
+def parse_stream_url(page_source):
+    '''
+    Find the .m3u8 stream url in the source of the player_h5/view page.
+
+    :return: The absolute stream url or None if the page has no video_url.
+    '''
+    match = STREAM_URL_PATTERN.search(page_source)
+    if not match:
+        return None
+    path = match.group(1).replace('\\/', '/')
+    return f'https://cdn.littlefox.co.kr/{path}'
+
+
 class SeriesScraper:
     """
     This class is used to scrape information about the series on LFC.
     All the information is already stored in the file data/series.json, so you don't need to use this class. 
+
+    Series are added to a CatalogStore (pass one or the path of its database);
+    load data/series.json into it with CatalogStore.import_json and get it back with write_series_json.
     """
     homepage_url = 'https://chinese.littlefox.com/en/story'    
 
-    def __init__(self, series_json):
-        self.series_json = series_json
-        with open(series_json, 'r') as f:
-            self.series = json.load(f)
+    def __init__(self, catalog):
+        self.catalog = open_catalog(catalog)
 
     def scrape_series(self):
         """Adds the title, id and main url for each relevant story to the urls json
@@ -35,23 +172,26 @@ class SeriesScraper:
         soup = BeautifulSoup(response.text, 'html.parser')
         contents_divs = soup.find_all('div', class_='constents_wrap')
 
+        series = []
         for div in contents_divs:
             # We start at the 22nd series because the prior have fucked up subtitles and I don't want to parse them 
             id = div['data-smid']
             title = normalize_title(div.find('div', class_='thumb_titl').find('a').text)
             # main_url = os.path.join(self.homepage_url, 'contents_list', id)
-        
-            if id not in [entry['id'] for entry in self.series]:
-                self.series.append({
-                    'title': title,
-                    'id': id,
-                })
-        
-        self.write_series_json() 
-         
-    def write_series_json(self):
-        with open(self.series_json, 'w') as f:
-            json.dump(self.series, f, indent=4)
+            series.append({
+                'title': title,
+                'id': id,
+            })
+
+        # series that are already in the catalog are left as they are
+        self.catalog.add_series(series)
+
+    @property
+    def series(self):
+        return self.catalog.series()
+
+    def write_series_json(self, series_json):
+        self.catalog.export_json(series_json=series_json)
 
 
 class URLScraper:
@@ -59,44 +199,76 @@ class URLScraper:
     This class is used to scrape all the relevant urls from LFC.
     This includes .xml subtitle files and .m3u8 stream files.
     The urls are already stored in data/urls.json, so you do not need to use this class. 
+
+    Everything scraped is upserted into a CatalogStore one series at a time, so scrapers for
+    different series can run concurrently (also from separate processes) without overwriting
+    each other. write_urls_json exports the catalog in the urls.json format.
     '''
-    def __init__(self, title, id, urls_json):
+    site_url = 'https://chinese.littlefox.com'
+    player_path = '/en/player_h5/view'
+    # query parameter the player endpoint takes the episode id in
+    player_id_param = 'fc_id'
+
+    def __init__(self, title, id, catalog, transport=None):
         self.title = title
         self.id = id
-        self.urls_json = urls_json
-        with open(urls_json, 'r') as f:
-            self.urls = json.load(f)
-        self.main_url = f"https://chinese.littlefox.com/en/story/contents_list/{id}"
+        self.catalog = open_catalog(catalog)
+        self.transport = transport or HTTPTransport()
+        self.main_url = f"{self.site_url}/en/story/contents_list/{id}"
+        self.page_count = None
+        # whether self.transport's session is signed in, see login
+        self.logged_in = False
+
+    def for_series(self, title, id):
+        '''A scraper for another series on the same catalog and transport, signed in if this one is.'''
+        scraper = type(self)(title, id, self.catalog, transport=self.transport)
+        scraper.site_url = self.site_url
+        scraper.logged_in = self.logged_in
+        return scraper
+
+    @classmethod
+    def setup_all(cls, series, catalog, max_workers=8):
+        '''Run setup_json for every series in series (entries of series.json) concurrently.
+
+        All the scrapers share one transport and one catalog; each series is stored as soon as it's scraped.
+        '''
+        transport = HTTPTransport()
+        catalog = open_catalog(catalog)
+        catalog.add_series(series)
+        scrapers = [cls(entry['title'], entry['id'], catalog, transport=transport) for entry in series]
 
-    
-    def setup_json(self):
-        self.urls[self.title] = [] 
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(scraper.setup_json): scraper for scraper in scrapers}
+            for future in concurrent.futures.as_completed(futures):
+                scraper = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error("Error scraping series %s: %s", scraper.title, e)
 
-        titles = self.get_ep_titles()
-        ids = self.get_ep_ids()
+    @property
+    def episodes(self):
+        '''The catalog's episodes of this series, as urls.json entries.'''
+        return self.catalog.episodes(self.title)
 
-        for title, id in zip(titles, ids):
-            self.urls[self.title].append({
-                'title': title,
-                'id': id
-            })
+    def setup_json(self):
+        self.catalog.set_episodes(self.title, self.get_episodes())
 
-        self.write_urls_json()
+    def fetch_page(self, page):
+        '''
+        Fetch and parse one listing page of the series.
 
-    def get_page_count(self):
-        """
-        Get the total number of pages for the series.
-        
-        :return: The maximum page number or None if not found.
-        """
+        :return: The BeautifulSoup of the page or None if it couldn't be fetched.
+        '''
+        url = f'{self.main_url}?&page={page}'
         try:
-            response = requests.get(self.main_url)
-            response.raise_for_status()
+            response = self.transport.get(url)
         except requests.RequestException as e:
-            print(f"Error fetching main URL: {e}")
+            logger.warning("Error fetching page URL %s: %s", url, e)
             return None
+        return BeautifulSoup(response.text, 'html.parser')
 
-        soup = BeautifulSoup(response.text, 'html.parser')
+    def parse_page_count(self, soup):
         paging_div = soup.find('div', class_='lf_paging')
 
         if paging_div:
@@ -107,6 +279,61 @@ class URLScraper:
                 return max(page_numbers)
         return None
 
+    def parse_episodes(self, soup):
+        '''Extract the title and id of every episode on a listing page, both from the same div.item.'''
+        episodes = []
+        for item in soup.find_all('div', class_='item'):
+            input_element = item.find('input', class_='LF_CHK s2 contentsCheck')
+            if not input_element:
+                continue
+            title_span = item.find('span', class_='story_title_en')
+            episodes.append({
+                'title': title_span.text.strip() if title_span else '',
+                'id': input_element.get('value')
+            })
+        return episodes
+
+    def get_episodes(self, max_workers=8):
+        '''
+        Fetch every listing page of the series exactly once (pages 2..n in parallel)
+        and extract the episodes from them.
+
+        Raises RuntimeError if any page couldn't be fetched: a partial list would make
+        the catalog drop the missing episodes (and renumber the rest).
+
+        :return: A list of {'title', 'id'} dicts in site order.
+        '''
+        logger.info('Getting episodes for %s', self.title)
+        first_page = self.fetch_page(1)
+        if first_page is None:
+            raise RuntimeError(f"Couldn't fetch the first listing page of {self.title}")
+
+        self.page_count = self.parse_page_count(first_page) or 1
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pages = [first_page] + list(executor.map(self.fetch_page, range(2, self.page_count + 1)))
+
+        failed = [page for page, soup in enumerate(pages, 1) if soup is None]
+        if failed:
+            raise RuntimeError(f"Couldn't fetch listing pages {failed} of {self.title}")
+
+        episodes = []
+        for soup in pages:
+            episodes.extend(self.parse_episodes(soup))
+        return episodes
+
+    def get_page_count(self):
+        """
+        Get the total number of pages for the series.
+        
+        :return: The maximum page number or None if not found.
+        """
+        if self.page_count is None:
+            soup = self.fetch_page(1)
+            if soup is None:
+                return None
+            self.page_count = self.parse_page_count(soup)
+        return self.page_count
+
     def get_page_urls(self):
         """
         Generate a list of URLs for all pages in the series.
@@ -117,7 +344,7 @@ class URLScraper:
         if max_page_count:
             return [f'{self.main_url}?&page={page}' for page in range(1, max_page_count + 1)]
         else:
-            print("No pages found")
+            logger.warning("No pages found for %s", self.title)
             return None
 
     def get_ep_ids(self):
@@ -126,28 +353,7 @@ class URLScraper:
         
         :return: A list of episode IDs.
         """
-        print(f'Getting episode IDs for {self.title}')
-        page_urls = self.get_page_urls()
-        if not page_urls:
-            return []
-
-        ids = []
-        for url in page_urls:
-            try:
-                response = requests.get(url)
-                response.raise_for_status()
-            except requests.RequestException as e:
-                print(f"Error fetching page URL {url}: {e}")
-                continue
-
-            soup = BeautifulSoup(response.text, 'html.parser')
-            items = soup.find_all('div', class_='item')
-            ids.extend(
-                input_element.get('value')
-                for item in items
-                if (input_element := item.find('input', class_='LF_CHK s2 contentsCheck'))
-            )
-        return ids
+        return [episode['id'] for episode in self.get_episodes()]
     
     def get_ep_titles(self):
         '''
@@ -155,35 +361,14 @@ class URLScraper:
 
         :return: A list of episode titles.
         '''
-        print(f'Getting episode titles for {self.title}')
-        page_urls = self.get_page_urls()
-        if not page_urls:
-            return []
-    
-        titles = []
-        for url in page_urls:
-            try:
-                response = requests.get(url)
-                response.raise_for_status()
-            except requests.RequestException as e:
-                print(f"Error fetching page URL {url}: {e}")
-                continue
-    
-            soup = BeautifulSoup(response.text, 'html.parser')
-            items = soup.find_all('div', class_='item')
-            titles.extend(
-                item.find('span', class_='story_title_en').text.strip()
-                for item in items
-                if item.find('span', class_='story_title_en')
-            )
-        return titles
+        return [episode['title'] for episode in self.get_episodes()]
 
     def write_xml_urls(self):
-        for i, ep in enumerate(self.urls[self.title]):
-            xml_url = f'https://cdn.littlefox.co.kr/cn/captionxml/{ep['id']}.xml'
-            self.urls[self.title][i]['xml_url'] = xml_url
-        
-        self.write_urls_json()
+        xml_urls = {}
+        for ep in self.episodes:
+            xml_urls[ep['id']] = f'https://cdn.littlefox.co.kr/cn/captionxml/{ep['id']}.xml'
+
+        self.catalog.set_urls(self.title, 'xml_url', xml_urls)
 
 
     def get_stream_urls(self):
@@ -205,37 +390,37 @@ class URLScraper:
         stream_urls = []        
     
         page_urls = self.get_page_urls()
-        print(f"Page URLs: {page_urls}")
+        logger.debug("Page URLs: %s", page_urls)
     
         driver = webdriver.Chrome()
     
         # sign in
-        print("Navigating to login page...")
+        logger.info("Navigating to login page...")
         driver.get("https://chinese.littlefox.com/en")
         driver.find_element(By.NAME, 'loginid').send_keys(username)
         driver.find_element(By.NAME, 'loginpw').send_keys(password)
         driver.find_element(By.CLASS_NAME, 'btn_login').click()
     
         time.sleep(3)
-        print("Logged in successfully.")
+        logger.info("Logged in successfully.")
     
         for page_url in page_urls:
-            print(f"Navigating to page URL: {page_url}")
+            logger.info("Navigating to page URL: %s", page_url)
             driver.get(page_url)
         
             # Wait for the parent element to be present
             list_wrap = WebDriverWait(driver, 10).until(
                 EC.presence_of_element_located((By.CLASS_NAME, 'list_wrap'))
             )
-            print("Found list_wrap element.")
+            logger.debug("Found list_wrap element.")
     
             # Find the thumb_wrap elements within the list_wrap
             thumb_wraps = list_wrap.find_elements(By.CLASS_NAME, 'thumb_wrap')
-            print(f"Found {len(thumb_wraps)} thumb_wrap elements.")
+            logger.debug("Found %d thumb_wrap elements.", len(thumb_wraps))
     
             # Loop through each element and click on it
             for i in range(len(thumb_wraps)):
-                print(f"Processing thumb_wrap element {i+1}/{len(thumb_wraps)}")
+                logger.debug("Processing thumb_wrap element %d/%d", i + 1, len(thumb_wraps))
                 # Refetch the thumb_wrap elements
                 list_wrap = WebDriverWait(driver, 10).until(
                     EC.presence_of_element_located((By.CLASS_NAME, 'list_wrap'))
@@ -246,21 +431,19 @@ class URLScraper:
                 WebDriverWait(driver, 10).until(
                     EC.element_to_be_clickable(thumb_wraps[i])
                 ).click()
-                print(f"Clicked on thumb_wrap element {i+1}")
+                logger.debug("Clicked on thumb_wrap element %d", i + 1)
                 time.sleep(5)  # Adjust the sleep time as needed to allow for page load or other actions
                 driver.get("https://chinese.littlefox.com/en/player_h5/view")
                 
                 # Extract the page source
                 page_source = driver.page_source
                 
-                # Use regex to find the stream.m3u8 URL
-                match = re.search(r'video_url":"(\\/contents_5\\/cn\\/hls\\/1080\\/[^"]+\\/stream\.m3u8\?_[^"]+)"', page_source)
-                if match:
-                    stream_url = f'https://cdn.littlefox.co.kr/{match.group(1).replace('\\/', '/')}'
-                    print(f"Found stream URL: {stream_url}")
+                stream_url = parse_stream_url(page_source)
+                if stream_url:
+                    logger.debug("Found stream URL: %s", stream_url)
                     stream_urls.append(stream_url)
                 else:
-                    print("Stream URL not found")
+                    logger.warning("Stream URL not found on %s", page_url)
                     stream_urls.append(None)
                 
                 # Navigate back to the content list page
@@ -268,284 +451,463 @@ class URLScraper:
                 time.sleep(3)  # Adjust the sleep time as needed to allow for page load or other actions
     
         driver.quit()
-        print("Closed the browser.")
+        logger.info("Closed the browser.")
     
         return stream_urls
 
-    def write_stream_urls(self):
-        # Check if all episodes already have a 'stream_url'
-        all_have_stream_urls = all('stream_url' in ep for ep in self.urls[self.title])
+    def login(self):
+        '''
+        Sign the transport's session in with LFC_USERNAME / LFC_PASSWORD by submitting the homepage login form.
 
-        if not all_have_stream_urls:
-            stream_urls = self.get_stream_urls()
-            for i, url in enumerate(stream_urls):
-                print(f"Updating URL for index {i}: {url}")
-                self.urls[self.title][i]['stream_url'] = url
+        Raises RuntimeError if the credentials aren't set or the site still shows the login form afterwards.
+        '''
+        from dotenv import load_dotenv
 
-            self.write_urls_json()
-            print("URLs written to JSON.")
-        else:
-            print("All episodes already have stream URLs.")
+        load_dotenv()
+        username = os.getenv('LFC_USERNAME')
+        password = os.getenv('LFC_PASSWORD')
+        if not username or not password:
+            raise RuntimeError("LFC_USERNAME and LFC_PASSWORD must be set (e.g. in .env) to resolve stream urls")
+
+        response = self.transport.get(f'{self.site_url}/en')
+        soup = BeautifulSoup(response.text, 'html.parser')
+        login_input = soup.find('input', attrs={'name': 'loginid'})
+        if login_input is None or login_input.find_parent('form') is None:
+            raise RuntimeError("Login form not found on the homepage")
+        form = login_input.find_parent('form')
+
+        data = {
+            input_element['name']: input_element.get('value', '')
+            for input_element in form.find_all('input') if input_element.get('name')
+        }
+        data['loginid'] = username
+        data['loginpw'] = password
+        self.transport.request('POST', urljoin(response.url, form.get('action') or ''), data=data)
+
+        # signed in, the homepage shows the account menu instead of the login form
+        response = self.transport.get(f'{self.site_url}/en')
+        if BeautifulSoup(response.text, 'html.parser').find('input', attrs={'name': 'loginid'}) is not None:
+            raise RuntimeError(f"Login as {username} failed, check LFC_USERNAME and LFC_PASSWORD")
+        self.logged_in = True
+        logger.info("Logged in successfully.")
+
+    def resolve_stream_url(self, ep_id):
+        '''Read the stream url of one episode straight from the player_h5/view payload.'''
+        try:
+            response = self.transport.get(f'{self.site_url}{self.player_path}', params={self.player_id_param: ep_id})
+        except requests.RequestException as e:
+            logger.warning("Error fetching player for %s: %s", ep_id, e)
+            return None
+        return parse_stream_url(response.text)
+
+    def resolve_stream_urls(self, max_workers=8, selenium_fallback=True):
+        '''
+        Get the urls for the .m3u8 stream files without a browser: log in (unless the session
+        already is, see for_series), then read the player payload of many episodes concurrently.
+        Episodes that can't be resolved this way are retried with the Selenium scraper (get_stream_urls).
+
+        :return: A list of stream urls (None where not found), in the order of self.episodes.
+        '''
+        if not self.logged_in:
+            self.login()
 
+        ep_ids = [ep['id'] for ep in self.episodes]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            stream_urls = list(executor.map(self.resolve_stream_url, ep_ids))
 
-    def write_urls_json(self):
-        with open(self.urls_json, 'w') as f:
-            json.dump(self.urls, f, indent=4)
+        missing = [i for i, url in enumerate(stream_urls) if url is None]
+        if missing and selenium_fallback:
+            logger.warning("%d stream URLs not resolved over HTTP, falling back to Selenium", len(missing))
+            selenium_urls = self.get_stream_urls()
+            for i in missing:
+                if i < len(selenium_urls):
+                    stream_urls[i] = selenium_urls[i]
+
+        return stream_urls
+
+    def write_stream_urls(self, refresh=False, max_workers=8):
+        '''Resolve and store the stream urls, also for episodes that already have one if refresh is set.'''
+        # Check if all episodes already have a 'stream_url'
+        episodes = self.episodes
+        all_have_stream_urls = all('stream_url' in ep for ep in episodes)
+
+        if refresh or not all_have_stream_urls:
+            stream_urls = self.resolve_stream_urls(max_workers)
+            self.catalog.set_urls(self.title, 'stream_url', {ep['id']: url for ep, url in zip(episodes, stream_urls)})
+            logger.info("Stream URLs written to the catalog.")
+        else:
+            logger.info("All episodes already have stream URLs.")
+
+    def write_urls_json(self, urls_json):
+        self.catalog.export_json(urls_json=urls_json)
 
 
 
 class Downloader:
     '''This class is used to download the content written to the urls.json file
+
+    All requests go through one shared HTTPTransport (pooled session, retries with backoff).
+    Pass your own transport to tune pool size, per-host concurrency or retry settings.
+
+    All download jobs run on one Scheduler: captions before playlists before video segments,
+    with per-host rate limits, an optional global bandwidth cap (bytes per second)
+    and concurrency that backs off when the cdn answers 429/5xx.
+
+    Files that already exist are re-validated with conditional requests against the
+    ETag / Last-Modified recorded in the output directory's .http_cache.json,
+    so a re-sync only rewrites what changed upstream.
+
+    Every file is written to a temporary path and renamed into place, and each job's state is kept
+    in the output directory's .jobs.sqlite3 journal. A run that was killed or left failures behind
+    is resumed from the journal: completed jobs are skipped without looking at the files,
+    and only failed or unfinished ones run again (pass refresh=True to redo everything).
+    Pass wal=False when the output directory is on a filesystem shared by download workers
+    on several machines (see work): the journal then uses SQLite's rollback journal.
+
+    rendition (a RenditionPreference) picks the resolution / bitrate of the videos, or audio only
+    (saved as .m4a instead of .mp4); by default the best rendition is downloaded.
+
+    series and episodes narrow the work down before anything is read from disk:
+    series is a list of series names or glob patterns, episodes a spec like '1-10,15,20-,*dragon*'
+    (see select_content). Nothing is loaded or created until a download method runs,
+    and episode directories are only made when a file is first written into them.
     '''
-    def __init__(self, urls_json, output_directory):
+    cache_filename = '.http_cache.json'
+    journal_filename = '.jobs.sqlite3'
+
+    def __init__(self, urls_json, output_directory, transport=None, scheduler=None, series=None, episodes=None,
+                 rendition=None, wal=True):
         self.urls_json = urls_json
         self.output_directory = output_directory
+        self.scheduler = scheduler or Scheduler()
+        self.transport = transport or HTTPTransport(scheduler=self.scheduler)
+        if self.transport.scheduler is None:
+            self.transport.scheduler = self.scheduler
+        self.rendition = rendition or RenditionPreference()
+        self.hls = HLSDownloader(self.transport, self.scheduler, self.rendition)
+
+        self.series = series
+        self.episodes = episodes
+        self._content_dictionary = None
+        self.created_directories = set()
+        self._journal = None
+        self.wal = wal
+        self.http_cache = ConditionalCache(os.path.join(output_directory, self.cache_filename))
+
+    @property
+    def content_dictionary(self):
+        '''The selected part of the catalog, loaded on first use.'''
+        if self._content_dictionary is None:
+            self._content_dictionary = select_content(load_catalog(self.urls_json), self.series, self.episodes)
+        return self._content_dictionary
+
+    @property
+    def journal(self):
+        '''The output directory's JobJournal, opened on first use.'''
+        if self._journal is None:
+            self.ensure_directory(self.output_directory)
+            self._journal = JobJournal(os.path.join(self.output_directory, self.journal_filename), wal=self.wal)
+        return self._journal
+
+    def job_key(self, path):
+        return os.path.relpath(path, self.output_directory)
+
+    def plan_jobs(self, kind, tasks, refresh=False, revalidate=True):
+        '''
+        Drop the (url, path) tasks the journal has as done and queue the rest as pending.
 
-        with open(urls_json, 'r') as f:
-            self.urls = json.load(f)
-
-        self.content_dictionary = self.build_content_dictionary()
-        self.setup_output_directory()
-
-    def build_content_dictionary(self):
-        '''I think the only reason I'm doing this is because I didn't think ahead while building the urls json
-           and I don't want to build it again cuz I had to let it run overnight...
+        If any of the tasks is still pending or running, the previous batch was interrupted
+        and is resumed: only the jobs that aren't done (including failed ones) run. Once a batch ran
+        to the end the next one runs every task again: done jobs are revalidated (fetches are cheap
+        conditional requests) and failed ones retried, unless revalidate is False, which only retries.
+        refresh runs every task regardless of the journal.
         '''
-        content_dic = {}
-        for elem in self.urls:
-            series_dic = {}
-            ep_cnt = 1
-            for info in self.urls[elem]:
-                ep_name = f'{ep_cnt}_{normalize_title(info['title'])}'
-                series_dic[ep_name] = {
-                    'xml_url': info['xml_url'],
-                    'stream_url': info['stream_url']
-                }
-                ep_cnt += 1
-
-            content_dic[elem] = series_dic
-        
-        return content_dic
+        states = self.journal.states(kind)
+        resuming = any(states.get(self.job_key(path)) in (PENDING, RUNNING) for _, path in tasks)
+        if not refresh and (resuming or not revalidate):
+            tasks = [(url, path) for url, path in tasks if states.get(self.job_key(path)) != DONE]
+        self.journal.queue(kind, [self.job_key(path) for _, path in tasks])
+        return tasks
+
+    def ensure_directory(self, directory):
+        '''Create directory the first time something is written into it.'''
+        if directory not in self.created_directories:
+            os.makedirs(directory, exist_ok=True)
+            self.created_directories.add(directory)
 
     def setup_output_directory(self):
-        # make sure output directory exists
-        if not os.path.exists(self.output_directory):
-            os.makedirs(self.output_directory)
-        
-        # make sure series directories exist
+        '''Create every selected episode directory up front (downloads create them lazily anyway).'''
         for series in self.content_dictionary:
-            series_dir = os.path.join(self.output_directory, series)
-            if not os.path.exists(series_dir):
-                os.makedirs(series_dir)
-
-            # make sure each episode directory exists
             for ep in self.content_dictionary[series]:
-                ep_dir = os.path.join(series_dir, ep)
-                if not os.path.exists(ep_dir):
-                    os.makedirs(ep_dir)
+                self.ensure_directory(os.path.join(self.output_directory, series, ep))
+
+    def fetch_to_file(self, url, path):
+        '''
+        Download url to path, sending conditional headers if the file already exists.
 
-    def download_xml_subtitles(self, max_threads):
+        :return: True if the file was written, False if the server reported it unchanged.
+        '''
+        with registry.timer('fetch'):
+            headers = self.http_cache.conditional_headers(url, path)
+            response = self.transport.get(url, headers=headers)
+
+        if response.status_code == 304:
+            self.http_cache.record(url, response, path=path)
+            registry.inc('files_unchanged_total')
+            return False
+
+        content = response.content
+        if os.path.exists(path) and self.http_cache.is_unchanged(url, content):
+            self.http_cache.record(url, response, content=content)
+            registry.inc('files_unchanged_total')
+            return False
+
+        with registry.timer('write'):
+            self.ensure_directory(os.path.dirname(path))
+            write_atomic(path, content, 'wb')
+        self.http_cache.record(url, response, content=content)
+        registry.inc('files_written_total')
+        return True
+
+    def fetch_task(self, kind, url, path):
+        '''fetch_to_file for a scheduler job: journals and logs instead of raising, and returns whether it succeeded.'''
+        key = self.job_key(path)
+        self.journal.start(kind, key)
+        try:
+            if self.fetch_to_file(url, path):
+                logger.debug("Downloaded %s to %s", url, path)
+            else:
+                logger.debug("%s is unchanged, skipped write", url)
+        except requests.exceptions.RequestException as e:
+            logger.warning("Failed to download %s: %s", url, e)
+            self.journal.fail(kind, key, e)
+            return False
+        self.journal.finish(kind, key)
+        return True
+
+    def run_fetch_jobs(self, priority, tasks, kind, refresh=False):
+        '''Queue the (url, path) fetches the journal doesn't have as done and wait for them with a progress line.'''
+        for _ in self.iter_fetch_jobs(priority, tasks, kind, refresh):
+            pass
+
+    def iter_fetch_jobs(self, priority, tasks, kind, refresh=False):
+        '''
+        run_fetch_jobs as a generator of (path, ok) for every task: first the ones the journal
+        has as done (which aren't fetched), then the others as soon as their fetch finishes.
+        '''
+        planned = self.plan_jobs(kind, tasks, refresh)
+        planned_paths = {path for _, path in planned}
+        for _, path in tasks:
+            if path not in planned_paths:
+                yield path, True
+
+        progress = Progress(len(planned), kind)
+        futures = {self.scheduler.submit(priority, self.fetch_task, kind, url, path): path for url, path in planned}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                ok = future.result()
+            except Exception as e:
+                logger.error("Error downloading file: %s", e)
+                ok = False
+            progress.update(failed=not ok)
+            yield futures[future], ok
+        progress.close()
+        if planned:
+            self.ensure_directory(self.output_directory)
+            self.http_cache.save()
+
+    def xml_tasks(self):
+        '''(url, path) of the XML subtitles of every selected episode that has an xml url.'''
         tasks = []
         for series in self.content_dictionary:
-            print(f"Processing series: {series}")
             for ep in self.content_dictionary[series]:
                 xml_url = self.content_dictionary[series][ep]['xml_url']
-                xml_path = os.path.join(self.output_directory, series, ep, f'{ep}.xml')
-                
-                if os.path.exists(xml_path):
-                    print(f"XML for episode {ep} already exists. Skipping download.")
+                if not xml_url:
                     continue
-    
-                print(f"Queueing download for XML of episode: {ep} from {xml_url}")
+                xml_path = os.path.join(self.output_directory, series, ep, f'{ep}.xml')
                 tasks.append((xml_url, xml_path))
-    
-        def download_task(xml_url, xml_path):
-            print(f"Downloading XML for episode from {xml_url}")
-            try:
-                response = requests.get(xml_url)
-                response.raise_for_status()  # Raise an HTTPError for bad responses
-                xml_content = response.text
-                with open(xml_path, 'w') as f:
-                    f.write(xml_content)
-                print(f"Successfully downloaded and saved XML for episode from {xml_url}")
-            except requests.exceptions.RequestException as e:
-                print(f"Failed to download {xml_url}: {e}")
-    
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-            futures = [executor.submit(download_task, url, path) for url, path in tasks]
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f"Error downloading file: {e}")
-
-    def download_stream_files(self):
-        for series in self.content_dictionary:
-            print(f"Processing series: {series}")
-            for ep in self.content_dictionary[series]:
-                stream_url = self.content_dictionary[series][ep]['stream_url']
-                stream_path = os.path.join(self.output_directory, series, ep, f'{ep}.m3u8')
-                
-                if os.path.exists(stream_path):
-                    print(f"Stream for episode {ep} already exists. Skipping download.")
-                    continue
-
-                print(f"Downloading stream for episode: {ep} from {stream_url}")
-                try:
-                    response = requests.get(stream_url)
-                    response.raise_for_status()  # Raise an HTTPError for bad responses
-                    stream_content = response.text
-                    with open(stream_path, 'w') as f:
-                        f.write(stream_content)
-                    print(f"Successfully downloaded and saved stream for episode: {ep}")
-                except requests.exceptions.RequestException as e:
-                    print(f"Failed to download {stream_url}: {e}")
-
-    def download_ep_mp4(self, m3u8_url, output_path):
-        """Download the mp4 file from the m3u8 URL using ffmpeg"""
-        import subprocess
-        import os
+        return tasks
 
-        print(f"Starting download for {output_path} from {m3u8_url}")
+    def download_xml_subtitles(self, max_threads=None, refresh=False):
+        for _ in self.iter_xml_subtitles(max_threads, refresh):
+            pass
 
-        if not os.path.exists(os.path.dirname(output_path)):
-            os.makedirs(os.path.dirname(output_path))
-            print(f"Created directory {os.path.dirname(output_path)}")
-
-        # ffmpeg command to download the mp4 file from the m3u8 URL
-        command = [
-            "ffmpeg",
-            "-loglevel", "error",  # Suppress all but error messages
-            "-i", m3u8_url,        # Input URL (.m3u8)
-            "-c", "copy",          # Copy codec (avoid re-encoding)
-            "-bsf:a", "aac_adtstoasc",  # Bitstream filter for audio
-            output_path            # Output file (.mp4)
-        ]
+    def iter_xml_subtitles(self, max_threads=None, refresh=False):
+        '''
+        download_xml_subtitles as a generator of the XML files that are on disk and ready to convert:
+        the ones already downloaded first, then each of the others as soon as its download finishes.
+        '''
+        if max_threads:
+            self.scheduler.set_max_workers(max_threads)
 
-        # Run the command using subprocess
-        try:
-            subprocess.run(command, check=True)
-            print(f"Successfully downloaded {output_path}")
-        except subprocess.CalledProcessError as e:
-            print(f"Failed to download {output_path}: {e}")
+        tasks = self.xml_tasks()
+        logger.info("Downloading %d XML subtitle files", len(tasks))
+        for path, ok in self.iter_fetch_jobs(CAPTIONS, tasks, 'xml', refresh):
+            if ok and os.path.exists(path):
+                yield path
 
-    def download_mp4s(self, max_threads):
-        """Make sure you have ffmpeg on your computer"""
+    def stream_tasks(self, extension='m3u8'):
+        '''(stream url, path of the <ep>.<extension> it's saved to) of every selected episode that has a stream url.'''
         tasks = []
         for series in self.content_dictionary:
-            print(f"Processing series: {series}")
             for ep in self.content_dictionary[series]:
                 stream_url = self.content_dictionary[series][ep]['stream_url']
-                mp4_path = os.path.join(self.output_directory, series, ep, f'{ep}.mp4')
-
-                if os.path.exists(mp4_path):
-                    print(f"MP4 for episode {ep} already exists. Skipping download.")
+                if not stream_url:
                     continue
+                stream_path = os.path.join(self.output_directory, series, ep, f'{ep}.{extension}')
+                tasks.append((stream_url, stream_path))
+        return tasks
+
+    def download_stream_files(self, max_threads=None, refresh=False):
+        if max_threads:
+            self.scheduler.set_max_workers(max_threads)
+
+        tasks = self.stream_tasks()
+        logger.info("Downloading %d stream playlists", len(tasks))
+        self.run_fetch_jobs(PLAYLISTS, tasks, 'm3u8', refresh)
 
-                print(f"Queueing download for {mp4_path} from {stream_url}")
-                tasks.append((stream_url, mp4_path))
+    def download_ep_mp4(self, m3u8_url, output_path, rendition=None):
+        """Download the mp4 file from the m3u8 URL, fetching the segments ourselves and remuxing with ffmpeg
 
+        rendition overrides the Downloader's RenditionPreference for this episode.
+
+        :return: True if the mp4 was written.
+        """
+        logger.debug("Starting download for %s from %s", output_path, m3u8_url)
+        self.ensure_directory(os.path.dirname(output_path))
+        key = self.job_key(output_path)
+        self.journal.start('mp4', key)
+
+        try:
+            self.hls.download(m3u8_url, output_path, rendition)
+        except (requests.exceptions.RequestException, SegmentError, subprocess.CalledProcessError) as e:
+            logger.warning("Failed to download %s: %s", output_path, e)
+            self.journal.fail('mp4', key, e)
+            return False
+        logger.debug("Downloaded %s", output_path)
+        self.journal.finish('mp4', key)
+        return True
+
+    def download_mp4s(self, max_threads, refresh=False):
+        """Make sure you have ffmpeg on your computer
+
+        max_threads is the number of episodes downloaded at once; their segments
+        are queued on the Downloader's scheduler as video jobs.
+        Episodes the journal has as done are never downloaded again unless refresh is set.
+        """
+        tasks = self.stream_tasks(self.rendition.extension)
+        states = self.journal.states('mp4')
+        if not refresh:
+            # mp4s downloaded before there was a journal were written in place by ffmpeg and may be
+            # truncated, so they're only adopted as done if they read back completely
+            unjournaled = [
+                mp4_path for _, mp4_path in tasks
+                if self.job_key(mp4_path) not in states and os.path.exists(mp4_path)
+            ]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
+                for mp4_path, complete in zip(unjournaled, executor.map(media_is_complete, unjournaled)):
+                    if complete:
+                        self.journal.finish('mp4', self.job_key(mp4_path))
+                    else:
+                        logger.warning("%s is incomplete, downloading it again", mp4_path)
+        tasks = self.plan_jobs('mp4', tasks, refresh, revalidate=False)
+
+        logger.info("Downloading %d MP4 files", len(tasks))
+        progress = Progress(len(tasks), 'mp4')
         with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
             futures = [executor.submit(self.download_ep_mp4, url, path) for url, path in tasks]
             for future in concurrent.futures.as_completed(futures):
                 try:
-                    future.result()
+                    ok = future.result()
                 except Exception as e:
-                    print(f"Error downloading file: {e}")
+                    logger.error("Error downloading file: %s", e)
+                    ok = False
+                progress.update(failed=not ok)
+        progress.close()
 
-class Converter:
-    def __init__(self, output_directory):
-        self.output_directory = output_directory
-    
-    def xml_to_srt(self):
-        '''Convert XML subtitle files to SRT format.'''
-        def ms_to_timedelta(ms):
-            return timedelta(milliseconds=int(ms))
-    
-        for root, _, _ in os.walk(self.output_directory):
-            for file in glob.glob(os.path.join(root, '*.xml')):
-                xml_path = file
-                srt_path = os.path.splitext(xml_path)[0] + '.srt'
-    
-                with open(xml_path, 'r', encoding='utf-8') as file:
-                    soup = BeautifulSoup(file, 'xml')
-    
-                subtitles = []
-    
-                paragraphs = soup.find_all('Paragraph')
-                for paragraph in paragraphs:
-                    start = ms_to_timedelta(paragraph.find('StartMilliseconds').text)
-                    end = ms_to_timedelta(paragraph.find('EndMilliseconds').text)
-                    text = paragraph.find('Text').text
+    def queue_mp4s(self, work_queue):
+        '''
+        Add an mp4 job for every selected episode with a stream url to a WorkQueue shared by download workers (see work).
+        Paths in the jobs are relative to the output directory, so workers may mount it elsewhere,
+        and every job carries the Downloader's RenditionPreference.
 
-                    subtitles.append(srt.Subtitle(index=len(subtitles) + 1, start=start, end=end, content=text))
-    
-                word_by_word = False
-                for subtitle in subtitles:
-                    if "[@" in subtitle.content:
-                        word_by_word = True
-                        break
+        :return: The number of jobs added (episodes already in the queue are skipped).
+        '''
+        jobs = []
+        for stream_url, path in self.stream_tasks(self.rendition.extension):
+            key = self.job_key(path)
+            jobs.append((key, {
+                'stream_url': stream_url,
+                'path': key,
+                'rendition': self.rendition.to_dict(),
+            }))
+        return work_queue.add(jobs)
+
+    def work(self, work_queue, threads=4, poll_interval=5):
+        '''
+        Run as a download worker: claim mp4 jobs from work_queue and download them,
+        threads episodes at a time, until the queue has nothing pending or leased left.
 
-                if word_by_word:
-                    subtitles = self.correct_word_by_word_subtitles(subtitles)
+        Leases are renewed by a heartbeat thread while the episodes download, so a job is only
+        handed to another worker if this process dies or stalls for longer than the lease.
+        Start as many workers as you like, on this or other machines sharing the output directory.
 
-                with open(srt_path, 'w', encoding='utf-8') as file: 
-                    file.write(srt.compose(subtitles))
-    
-                print(f"File converted successfully: {srt_path}")
-            
-    def correct_word_by_word_subtitles(self, subtitles):
-        if not subtitles:
-            return []
-    
-        for subtitle in subtitles:
-            subtitle.content = re.sub(r'\[@|\@\]', '', subtitle.content)
-                
-        new_subtitles = []
-        prev = None
-        start = subtitles[0].start
-    
-        for subtitle in subtitles:
-            if prev is None:
-                prev = subtitle
-                continue
-            if subtitle.content != prev.content:
-                end = prev.end                
-                new_subtitles.append(srt.Subtitle(index=len(new_subtitles) + 1, start=start, end=end, content=prev.content))
-                start = subtitle.start
-            prev = subtitle
-    
-        # Add the last subtitle
-        if prev is not None:
-            new_subtitles.append(srt.Subtitle(index=len(new_subtitles) + 1, start=start, end=prev.end, content=prev.content))
-    
-        # remove the pinyin lines
-        for subtitle in new_subtitles:
-            subtitle.content = self.remove_pinyin_line(subtitle.content)
-
-        return new_subtitles
-
-    def remove_pinyin_line(self, content):
-        # Regex pattern to match pinyin tone marks
-        tone_pattern = re.compile(r'[āáǎàēéěèīíǐìōóǒòūúǔùǖǘǚǜ]')
-        new_content = ""
-        for line in content.split("\n"):
-            if not tone_pattern.search(line):
-                new_content += line + "\n"
-        return new_content.strip()
-
-    def srt_to_txt(self):
-        '''Convert SRT subtitle files to plain text.'''
-        for root, _, _ in os.walk(self.output_directory):
-            for file in glob.glob(os.path.join(root, '*.srt')):
-                srt_path = file
-                txt_path = os.path.splitext(srt_path)[0] + '.txt'
-    
-                with open(srt_path, 'r', encoding='utf-8') as file:
-                    srt_content = file.read()
+        :return: The number of jobs this worker completed.
+        '''
+        worker = worker_name()
+        held = set()
+        lock = threading.Lock()
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(work_queue.lease_seconds / 3):
+                with lock:
+                    keys = list(held)
+                for key in work_queue.heartbeat(worker, keys):
+                    logger.warning("Lost the lease on %s", key)
+
+        def run():
+            completed = 0
+            while True:
+                job = work_queue.claim(worker)
+                if job is None:
+                    if not work_queue.unfinished():
+                        return completed
+                    # the remaining jobs are leased by other workers, wait in case one of them dies
+                    time.sleep(poll_interval)
+                    continue
 
-                subtitles = list(srt.parse(srt_content))
+                key, payload = job
+                with lock:
+                    held.add(key)
+                error = "download failed, see the worker's log"
+                try:
+                    ok = self.download_ep_mp4(payload['stream_url'], os.path.join(self.output_directory, payload['path']),
+                                              RenditionPreference(**payload['rendition']))
+                except Exception as e:
+                    # anything else (a full disk, a bad payload) fails the job instead of killing this thread
+                    logger.error("Error downloading %s: %s", key, e)
+                    self.journal.fail('mp4', key, e)
+                    ok, error = False, e
+                finally:
+                    with lock:
+                        held.discard(key)
+
+                if not ok:
+                    work_queue.fail(worker, key, error)
+                elif work_queue.complete(worker, key):
+                    completed += 1
+                else:
+                    logger.warning("%s was finished after its lease had expired", key)
 
-                with open(txt_path, 'w', encoding='utf-8') as file:
-                    for subtitle in subtitles:
-                        file.write(subtitle.content + '\n')
\ No newline at end of file
+        logger.info("Worker %s started", worker)
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+                futures = [executor.submit(run) for _ in range(threads)]
+                completed = sum(future.result() for future in futures)
+        finally:
+            stop.set()
+        logger.info("Worker %s completed %d jobs", worker, completed)
+        return completed
@@ -0,0 +1,167 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    completions INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, lease_expires);
+'''
+
+
+def worker_name():
+    '''Identify a worker process across machines: host, pid and a random suffix.'''
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+class WorkQueue:
+    '''
+    Shared job queue in one SQLite file, for any number of worker processes on one
+    or several machines.
+
+    A worker claims a job by taking a lease on it for lease_seconds and must renew
+    the lease (heartbeat) while it works. A job whose lease ran out (its worker died or
+    hung) can be claimed by someone else. complete() and fail() only count when they come
+    from the worker that currently holds the lease, so every job is completed once.
+    Jobs that failed max_attempts times are left as failed.
+
+    Every claim is an IMMEDIATE transaction, so two workers can never lease the same job.
+    WAL mode (the default) needs the processes on one machine; when the file is on a shared
+    filesystem for several machines pass wal=False, which uses SQLite's rollback journal
+    and the filesystem's locks instead.
+    '''
+    def __init__(self, queue_path, lease_seconds=120, max_attempts=5, wal=True):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.connection = sqlite3.connect(queue_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute(f'PRAGMA journal_mode={"WAL" if wal else "DELETE"}')
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def transaction(self, sql, parameters=()):
+        '''Run one statement in its own IMMEDIATE transaction and return (rowcount, fetched rows).'''
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                cursor = self.connection.execute(sql, parameters)
+                rows = cursor.fetchall()
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        return cursor.rowcount, rows
+
+    def add(self, jobs):
+        '''
+        Queue (key, payload) jobs; keys that are already queued (in any state) are left alone.
+
+        :return: The number of jobs added.
+        '''
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                cursor = self.connection.executemany(
+                    'INSERT INTO jobs (key, payload, updated) VALUES (?, ?, ?) ON CONFLICT (key) DO NOTHING',
+                    ((key, json.dumps(payload), now) for key, payload in jobs)
+                )
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        return cursor.rowcount
+
+    def claim(self, worker):
+        '''
+        Lease the next pending (or abandoned) job to worker.
+
+        :return: (key, payload) or None if there is nothing to claim right now.
+        '''
+        now = time.time()
+        _, rows = self.transaction(
+            '''UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, updated = ?
+               WHERE id = (
+                   SELECT id FROM jobs
+                   WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?)
+                   ORDER BY id LIMIT 1
+               )
+               RETURNING key, payload''',
+            (worker, now + self.lease_seconds, now, now)
+        )
+        if not rows:
+            return None
+        key, payload = rows[0]
+        return key, json.loads(payload)
+
+    def heartbeat(self, worker, keys):
+        '''
+        Extend worker's leases on keys.
+
+        :return: The keys it no longer holds (their lease expired and someone else took them).
+        '''
+        now = time.time()
+        lost = []
+        for key in keys:
+            count, _ = self.transaction(
+                '''UPDATE jobs SET lease_expires = ?, updated = ?
+                   WHERE key = ? AND state = 'leased' AND worker = ?''',
+                (now + self.lease_seconds, now, key, worker)
+            )
+            if not count:
+                lost.append(key)
+        return lost
+
+    def complete(self, worker, key):
+        '''Mark key done. Returns False if worker had lost the lease, in which case nothing changes.'''
+        count, _ = self.transaction(
+            '''UPDATE jobs SET state = 'done', completions = completions + 1, lease_expires = NULL, error = NULL, updated = ?
+               WHERE key = ? AND state = 'leased' AND worker = ?''',
+            (time.time(), key, worker)
+        )
+        return bool(count)
+
+    def fail(self, worker, key, error):
+        '''Give a job back after an error: it's retried until it has failed max_attempts times.'''
+        count, _ = self.transaction(
+            '''UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                   lease_expires = NULL, error = ?, updated = ?
+               WHERE key = ? AND state = 'leased' AND worker = ?''',
+            (self.max_attempts, str(error), time.time(), key, worker)
+        )
+        return bool(count)
+
+    def retry_failed(self):
+        '''Put every failed job back in the queue with a fresh attempt count.'''
+        count, _ = self.transaction("UPDATE jobs SET state = 'pending', attempts = 0 WHERE state = 'failed'")
+        return count
+
+    def counts(self):
+        '''Return a dict of state -> number of jobs.'''
+        with self.lock:
+            return dict(self.connection.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+
+    def unfinished(self):
+        '''Whether any job is still pending or leased.'''
+        with self.lock:
+            return self.connection.execute(
+                "SELECT EXISTS (SELECT 1 FROM jobs WHERE state IN ('pending', 'leased'))"
+            ).fetchone()[0] == 1